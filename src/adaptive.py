@@ -0,0 +1,228 @@
+# Module that decides how often each register needs polling.
+#
+# At night the PV registers sit at zero and the charge status reads "no
+# charging", yet a fixed rate polls them as often as at solar noon.
+# AdaptiveSchedule gives every register its own interval between a lower and
+# an upper bound:
+#
+#   - a register whose value did not move doubles its interval, one that moved
+#     by more than its deadband drops straight back to the fastest interval
+#   - while the controller says it is night and is not charging, the PV
+#     registers sit at their slowest interval
+#   - a day/night or charge state transition, or a raised alarm, puts every
+#     register back on the fastest interval at once
+import heapq
+import time
+
+import clock
+import commander
+import mappings
+import transport
+
+NIGHT = 0x200C
+CHARGING_STATUS = 0x3201
+
+# Registers that only mean something while the sun is up
+PV_REGISTERS = frozenset([0x3100, 0x3101, 0x3102])
+
+
+def chargingState(raw):
+    """
+    D3-D2 of the charging status word: 0 no charging, 1 float, 2 boost,
+    3 equalization.
+    """
+    return (raw & 0x000C) >> 2
+
+
+class AdaptiveSchedule(object):
+    def __init__(self, registers=None, minInterval=1.0, maxInterval=60.0,
+                 deadband=None):
+        """
+        @param registers: Dictionary of address to mappings.Register, all of
+                          mappings.REGISTERS by default
+        @param minInterval: The fastest any register is polled, in seconds
+        @param maxInterval: The slowest any register is polled, in seconds
+        @param deadband: Dictionary of address to the smallest raw change
+                         that counts as a change, 0 for the rest
+        """
+        if registers is None:
+            registers = mappings.REGISTERS
+        self.registers = registers
+        self.minInterval = minInterval
+        self.maxInterval = maxInterval
+        self.deadband = deadband or {}
+        self.night = None
+        self.charging = None
+        self.__intervals = dict.fromkeys(registers, minInterval)
+        self.__last = {}
+        # Heap of (due time, address) and the due time each address is at
+        self.__due = {}
+        self.__heap = []
+        now = clock.monotonic()
+        for addr in sorted(registers):
+            self.__schedule(addr, now)
+
+    def __schedule(self, addr, when):
+        self.__due[addr] = when
+        heapq.heappush(self.__heap, (when, addr))
+
+    def interval(self, address):
+        return self.__intervals[address]
+
+    def due(self, now=None):
+        """
+        Return the addresses that are due, in order, and take them off the
+        schedule until observe() puts them back on.
+        """
+        if now is None:
+            now = clock.monotonic()
+        ready = []
+        while self.__heap and self.__heap[0][0] <= now:
+            when, addr = heapq.heappop(self.__heap)
+            # Entries that were rescheduled since are stale, skip them
+            if self.__due.get(addr) == when:
+                del self.__due[addr]
+                ready.append(addr)
+        return ready
+
+    def nextDue(self):
+        """
+        clock.monotonic() time the next register is due, None if none are.
+        """
+        while self.__heap and self.__due.get(self.__heap[0][1]) != \
+                self.__heap[0][0]:
+            heapq.heappop(self.__heap)
+        return self.__heap[0][0] if self.__heap else None
+
+    def observe(self, address, raw, now=None):
+        """
+        Record a raw value that was just read and put the register back on
+        the schedule.
+        """
+        if now is None:
+            now = clock.monotonic()
+        if address == NIGHT:
+            night = bool(raw)
+            if self.night is not None and night != self.night:
+                self.night = night
+                self.reset(now)
+            self.night = night
+        elif address == CHARGING_STATUS:
+            state = chargingState(raw)
+            if self.charging is not None and state != self.charging:
+                self.charging = state
+                self.reset(now)
+            self.charging = state
+
+        last = self.__last.get(address)
+        self.__last[address] = raw
+        if last is not None and abs(raw - last) > self.deadband.get(address, 0):
+            interval = self.minInterval
+        else:
+            interval = min(self.__intervals[address] * 2, self.maxInterval)
+        if address in PV_REGISTERS and self.night and not self.charging:
+            interval = self.maxInterval
+        self.__intervals[address] = interval
+        self.__schedule(address, now + interval)
+
+    def retry(self, address, now=None):
+        """
+        Put a register whose read failed back on the schedule at the fastest
+        interval.
+        """
+        if now is None:
+            now = clock.monotonic()
+        self.__intervals[address] = self.minInterval
+        self.__schedule(address, now + self.minInterval)
+
+    def reset(self, now=None):
+        """
+        Put every register on the fastest interval and make it due now.  Call
+        this when an alarm is raised.
+        """
+        if now is None:
+            now = clock.monotonic()
+        for addr in self.registers:
+            self.__intervals[addr] = self.minInterval
+            self.__schedule(addr, now)
+
+
+class AdaptivePoller(object):
+    def __init__(self, link, deviceId, schedule, engine=None):
+        """
+        Poll one device following an AdaptiveSchedule.
+
+        @param link: The serial connection or transport.Transport to use
+        @param deviceId: The ID number of the device on the bus
+        @type schedule: AdaptiveSchedule
+        @type engine: alarms.AlarmEngine
+        @param engine: Gets every raw value, a raised alarm resets the
+                       schedule to the fastest interval
+        """
+        self.link = transport.wrap(link)
+        self.deviceId = deviceId
+        self.schedule = schedule
+        self.engine = engine
+
+    def poll(self):
+        """
+        Read every register that is due and return a dictionary of address
+        to Result for them.  Registers whose read fails are missing from it
+        and are tried again after the fastest interval.
+        """
+        due = self.schedule.due()
+        registers = self.schedule.registers
+        raws = {}
+        alarmed = False
+        results = {}
+        try:
+            bits = dict((addr, registers[addr]) for addr in due
+                        if commander.isBitAddress(addr))
+            if bits:
+                try:
+                    raws.update(commander.readBitValues(self.link,
+                                                        self.deviceId,
+                                                        bits))
+                except RuntimeError:
+                    pass
+            for addr in due:
+                if commander.isBitAddress(addr):
+                    continue
+                try:
+                    data = commander.transact(self.link,
+                                              self.deviceId,
+                                              addr,
+                                              registers[addr].numWords)
+                except RuntimeError:
+                    # A timeout, bad frame or exception reply only costs
+                    # this register, the rest of the poll goes on
+                    continue
+                raws[addr] = commander.combineBytes(data)
+        finally:
+            # Every register that was due goes back on the schedule, even
+            # when the port itself failed half way through
+            for addr in due:
+                if addr not in raws:
+                    self.schedule.retry(addr)
+                    continue
+                raw = raws[addr]
+                register = registers[addr]
+                results[addr] = register.unit(addr, raw, register.times)
+                self.schedule.observe(addr, raw)
+                if self.engine is not None:
+                    before = len(self.engine.active(self.deviceId))
+                    self.engine.observe(self.deviceId, addr, raw)
+                    alarmed |= len(self.engine.active(self.deviceId)) > before
+            if alarmed:
+                self.schedule.reset()
+        return results
+
+    def wait(self):
+        """
+        Sleep until the next register is due.
+        """
+        nextDue = self.schedule.nextDue()
+        if nextDue is not None:
+            delay = nextDue - clock.monotonic()
+            if delay > 0:
+                time.sleep(delay)
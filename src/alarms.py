@@ -0,0 +1,314 @@
+# Module for raising alarms straight from the raw status words.
+#
+# A Rule is a predicate over the raw value of one register (the integer
+# combineBytes returns, or the bit for coils and discrete inputs).  Rules are
+# indexed by address so each completed transaction only runs the handful of
+# rules that care about it.  On top of the predicate a rule can have:
+#
+#   hysteresis - a separate, looser predicate that has to hold to clear it
+#   debounce   - how many samples in a row it takes to raise or clear it
+#   rate limit - the shortest time between two notifications of it
+#
+# Events go to sinks, which are any callables taking an AlarmEvent.
+import logging
+import threading
+import time
+from collections import namedtuple
+
+import commander
+import mappings
+import transport
+
+BATTERY_STATUS = 0x3200
+CHARGING_STATUS = 0x3201
+DISCHARGING_STATUS = 0x3202
+OVER_TEMPERATURE = 0x2000
+
+log = logging.getLogger(__name__)
+
+
+class AlarmEvent(namedtuple("AlarmEvent", ["time",
+                                           "deviceId",
+                                           "name",
+                                           "address",
+                                           "raw",
+                                           "active",
+                                           "port"])):
+    """
+    @type time: float
+    @param time: Host time (seconds since the epoch) of the sample
+    @type deviceId: int
+    @param deviceId: The ID of the device on the bus
+    @type name: string
+    @param name: The name of the rule
+    @type address: int
+    @param address: The register the rule watches
+    @type raw: int
+    @param raw: The raw value that raised or cleared the alarm
+    @type active: bool
+    @param active: True when the alarm was raised, False when it cleared
+    @param port: The name of the bus the device is on, None if not given
+    """
+    __slots__ = ()
+
+
+class Rule(object):
+    def __init__(self, name, address, trigger, clear=None, debounce=1,
+                 minInterval=0):
+        """
+        @param name: Display name of the alarm
+        @param address: The register address the rule watches
+        @param trigger: Function of the raw value, True raises the alarm
+        @param clear: Function of the raw value, True clears the alarm.  By
+                      default the alarm clears once trigger is False.
+        @param debounce: Samples in a row needed to raise or clear
+        @param minInterval: Seconds that have to pass between two raise
+                            notifications, quieter raises are not sent
+        """
+        self.name = name
+        self.address = address
+        self.trigger = trigger
+        self.clear = clear or (lambda raw: not trigger(raw))
+        self.debounce = debounce
+        self.minInterval = minInterval
+
+
+def bitRule(name, address, bit, **kwargs):
+    """
+    Rule that is raised while one bit of a status word is set.
+    """
+    mask = 1 << bit
+    return Rule(name, address, lambda raw: bool(raw & mask), **kwargs)
+
+
+def fieldRule(name, address, mask, shift, values, **kwargs):
+    """
+    Rule that is raised while a bit field of a status word has one of the
+    given values.
+    """
+    values = frozenset(values)
+    return Rule(name,
+                address,
+                lambda raw: ((raw & mask) >> shift) in values,
+                **kwargs)
+
+
+def thresholdRule(name, address, times, above=None, below=None, hysteresis=0,
+                  **kwargs):
+    """
+    Rule that is raised while the converted value (raw / times) is above or
+    below a limit.  It clears once the value is back inside the limit by more
+    than hysteresis, in the same units.
+    """
+    times = float(times)
+    if above is not None:
+        return Rule(name,
+                    address,
+                    lambda raw: raw / times > above,
+                    lambda raw: raw / times <= above - hysteresis,
+                    **kwargs)
+    return Rule(name,
+                address,
+                lambda raw: raw / times < below,
+                lambda raw: raw / times >= below + hysteresis,
+                **kwargs)
+
+
+# The bits follow the controller data sheet, which puts the MOSFET, load and
+# PV short bits and the charging status in 0x3201.  The decoders in conversions
+# have the charging and discharging descriptions the other way around.
+DEFAULT_RULES = [
+    fieldRule("Battery over volt", BATTERY_STATUS, 0x000F, 0, [0x01]),
+    fieldRule("Battery low volt disconnect", BATTERY_STATUS, 0x000F, 0, [0x03]),
+    fieldRule("Battery fault", BATTERY_STATUS, 0x000F, 0, [0x04]),
+    fieldRule("Battery over temperature", BATTERY_STATUS, 0x00F0, 4, [0x01]),
+    bitRule("Charging MOSFET Short", CHARGING_STATUS, 13),
+    bitRule("Charging/Anti-Reverse MOSFET Short", CHARGING_STATUS, 12),
+    bitRule("Anti-reverse MOSFET Short", CHARGING_STATUS, 11),
+    bitRule("Input Overcurrent", CHARGING_STATUS, 10),
+    bitRule("Load Overcurrent", CHARGING_STATUS, 9),
+    bitRule("Load Short", CHARGING_STATUS, 8),
+    bitRule("Load MOSFET Short", CHARGING_STATUS, 7),
+    bitRule("PV Short", CHARGING_STATUS, 4),
+    bitRule("Short Circuit", DISCHARGING_STATUS, 11),
+    bitRule("Discharging fault", DISCHARGING_STATUS, 1),
+    bitRule("Over temperature inside the device", OVER_TEMPERATURE, 0),
+]
+
+
+class _State(object):
+    __slots__ = ("active", "streak", "lastNotified", "notified")
+
+    def __init__(self):
+        self.active = False
+        self.streak = 0
+        self.lastNotified = None
+        self.notified = False
+
+
+class AlarmEngine(object):
+    def __init__(self, rules=None, sinks=None):
+        """
+        @param rules: List of Rules, DEFAULT_RULES if not given
+        @param sinks: List of callables that get every AlarmEvent
+        """
+        self.rules = {}
+        for rule in (DEFAULT_RULES if rules is None else rules):
+            self.rules.setdefault(rule.address, []).append(rule)
+        self.sinks = list(sinks or [])
+        self.lock = threading.Lock()
+        self.__states = {}
+
+    def observe(self, deviceId, address, raw, when=None, port=None):
+        """
+        Run the rules for one register.  Call this as each transaction
+        completes.  Several pollers may share one engine.
+
+        @param port: The name of the bus the device is on.  Devices on
+                     different buses often have the same ID, so pass it
+                     whenever the engine is shared between buses.
+        """
+        rules = self.rules.get(address)
+        if not rules:
+            return
+        if when is None:
+            when = time.time()
+        events = []
+        with self.lock:
+            for rule in rules:
+                key = (port, deviceId, rule)
+                state = self.__states.get(key)
+                if state is None:
+                    state = self.__states[key] = _State()
+
+                # Count how many samples in a row want the alarm flipped
+                flip = rule.clear(raw) if state.active else rule.trigger(raw)
+                state.streak = state.streak + 1 if flip else 0
+                if state.streak < rule.debounce:
+                    continue
+                state.streak = 0
+                state.active = not state.active
+
+                if state.active:
+                    if (state.lastNotified is not None and
+                            when - state.lastNotified < rule.minInterval):
+                        state.notified = False
+                        continue
+                    state.lastNotified = when
+                    state.notified = True
+                elif not state.notified:
+                    # Nobody heard about it being raised
+                    continue
+                events.append(AlarmEvent(when, deviceId, rule.name, address,
+                                         raw, state.active, port))
+        # Outside the lock so sinks may call back into the engine
+        for event in events:
+            self.__dispatch(event)
+
+    def __dispatch(self, event):
+        for sink in self.sinks:
+            try:
+                sink(event)
+            except Exception:
+                log.exception("Alarm sink %r failed", sink)
+
+    def active(self, deviceId=None, port=None):
+        """
+        Return the Rules that are raised, for one device (on one bus) or all
+        of them.
+        """
+        with self.lock:
+            return [rule for (bus, dev, rule), state
+                    in self.__states.iteritems()
+                    if state.active and
+                    (deviceId is None or dev == deviceId) and
+                    (port is None or bus == port)]
+
+    def addresses(self):
+        """
+        Every address that has a rule.
+        """
+        return sorted(self.rules)
+
+
+def logSink(event):
+    """
+    Sink that writes every event to the alarms logger.
+    """
+    device = "Device %d" % event.deviceId
+    if event.port is not None:
+        device = "%s %s" % (event.port, device)
+    if event.active:
+        log.warning("%s: %s (0x%04x = 0x%04x)", device, event.name,
+                    event.address, event.raw)
+    else:
+        log.info("%s: %s cleared", device, event.name)
+
+
+class StatusWatcher(object):
+    def __init__(self, link, deviceId, engine, interval=5, fastInterval=0.2):
+        """
+        Poll the registers an AlarmEngine has rules for.  While any alarm of
+        the device is raised they are polled every fastInterval seconds
+        instead of every interval seconds.
+
+        @param link: The serial connection or transport.Transport to use
+        @param deviceId: The ID number of the device on the bus
+        @type engine: AlarmEngine
+        """
+        self.link = transport.wrap(link)
+        self.deviceId = deviceId
+        self.engine = engine
+        self.interval = interval
+        self.fastInterval = fastInterval
+        self.bitRegisters = {}
+        self.wordRegisters = []
+        for addr in engine.addresses():
+            register = mappings.REGISTERS.get(addr)
+            numWords = register.numWords if register is not None else 1
+            if commander.isBitAddress(addr):
+                self.bitRegisters[addr] = register
+            else:
+                self.wordRegisters.append((addr, numWords))
+
+    def poll(self):
+        """
+        Read every watched register once and feed the engine.  A register
+        whose read fails is skipped until the next poll.  Returns the number
+        of seconds to wait before the next poll.
+        """
+        if self.bitRegisters:
+            try:
+                bits = commander.readBitValues(self.link,
+                                               self.deviceId,
+                                               self.bitRegisters)
+            except RuntimeError as e:
+                # Try again next poll, flaky buses are where alarms happen
+                log.debug("Device %d: reading bits failed: %s",
+                          self.deviceId, e)
+                bits = {}
+            when = time.time()
+            for addr, value in bits.iteritems():
+                self.engine.observe(self.deviceId, addr, value, when)
+        for addr, numWords in self.wordRegisters:
+            try:
+                data = commander.transact(self.link, self.deviceId, addr,
+                                          numWords)
+            except RuntimeError as e:
+                log.debug("Device %d: reading 0x%04x failed: %s",
+                          self.deviceId, addr, e)
+                continue
+            self.engine.observe(self.deviceId,
+                                addr,
+                                commander.combineBytes(data),
+                                time.time())
+        if self.engine.active(self.deviceId):
+            return self.fastInterval
+        return self.interval
+
+    def run(self, running=lambda: True):
+        """
+        Poll until running() returns False.
+        """
+        while running():
+            time.sleep(self.poll())
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+#
+# Bus arbiter for the Renogy Commander.
+#
+# Only one process can hold the serial port at a time.  When the GUI, a logger
+# and an ad-hoc commander.py run all open the port they trample on each others
+# frames.  The arbiter is a small daemon that owns the port, runs one Modbus
+# transaction at a time and serves any number of local clients over a Unix
+# socket.  It opens the port exclusively and will not start while another
+# arbiter still answers on the socket.
+#
+# The protocol is one JSON object per line in each direction:
+#
+#   -> {"device": 1, "address": 12544, "words": 1, "maxAge": 0.5}
+#   <- {"ok": true, "data": [4, 210], "age": 0.12}
+#   <- {"ok": false, "error": "..."}
+#
+# "data" holds the raw reply bytes (header and CRC stripped) so the client can
+# do the conversion with the usual Register unit function.  "maxAge" is how old
+# (in seconds) a cached value may be and still be acceptable to the caller.  A
+# maxAge of 0 always gets a read that started after it asked.  Identical reads
+# that arrive while one is waiting for the bus share it instead of queueing
+# their own.  A read that is already on the bus is only shared with callers
+# whose maxAge it still meets.  Ages count from when the transaction started.
+import argparse
+import json
+import os
+import socket
+import SocketServer
+import threading
+
+import clock
+import commander
+import transport
+
+DEFAULT_SOCKET = "/tmp/mpptCommander.sock"
+
+
+class _Pending(object):
+    """
+    A transaction that is on the bus, or waiting for it, that other callers
+    asking for the same thing can wait on.
+    """
+    __slots__ = ("event", "data", "error", "started")
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.data = None
+        self.error = None
+        # clock.monotonic() time the transaction went on the bus, None while
+        # it is still waiting for it
+        self.started = None
+
+
+# Function codes whose replies only depend on the state of the device and
+# so can be cached.  Anything else goes straight to the bus every time.
+READ_FUNCTIONS = frozenset([0x01, 0x02, 0x03, 0x04])
+
+
+class Bus(object):
+    def __init__(self, link, debug=False):
+        """
+        Owns a serial connection and serializes every transaction on it.
+
+        Recent replies to reads are kept in a cache keyed by the request so
+        that callers that can tolerate slightly stale values never touch the
+        bus.  Any other request (a write) drops the cached replies of that
+        device.
+
+        @param link: The serial connection or transport.Transport to own
+        @param debug: Passed through to Transport.transact
+        """
+        self.__transport = transport.wrap(link)
+        self.__debug = debug
+        self.__busLock = threading.Lock()
+        self.__stateLock = threading.Lock()
+        self.__cache = {}
+        self.__inflight = {}
+        self.transactions = 0
+        self.cacheHits = 0
+        self.coalesced = 0
+
+    def request(self, deviceId, function, payload, maxAge=0):
+        """
+        Return a (reply, age) tuple where reply is what Transport.transact
+        returned for the request and age is how old it is in seconds, counted
+        from when its transaction started.
+
+        @param maxAge: The oldest cached value in seconds the caller accepts
+        """
+        if function not in READ_FUNCTIONS:
+            with self.__busLock:
+                self.transactions += 1
+                try:
+                    return self.__transport.transact(deviceId,
+                                                      function,
+                                                      payload,
+                                                      debug=self.__debug), 0.0
+                finally:
+                    with self.__stateLock:
+                        for key in self.__cache.keys():
+                            if key[0] == deviceId:
+                                del self.__cache[key]
+
+        key = (deviceId, function, bytes(bytearray(payload)))
+        with self.__stateLock:
+            now = clock.monotonic()
+            cached = self.__cache.get(key)
+            if cached is not None and maxAge > 0:
+                age = now - cached[0]
+                if age <= maxAge:
+                    self.cacheHits += 1
+                    return cached[1], age
+            pending = self.__inflight.get(key)
+            # Only share a read that reaches the bus after we asked, or one
+            # that is already on it if it is recent enough for us
+            owner = pending is None or (pending.started is not None and
+                                        now - pending.started > maxAge)
+            if owner:
+                pending = _Pending()
+                self.__inflight[key] = pending
+            else:
+                self.coalesced += 1
+
+        if not owner:
+            pending.event.wait()
+            if pending.error is not None:
+                raise pending.error
+            return pending.data, clock.monotonic() - pending.started
+
+        try:
+            with self.__busLock:
+                self.transactions += 1
+                with self.__stateLock:
+                    pending.started = clock.monotonic()
+                pending.data = self.__transport.transact(deviceId,
+                                                         function,
+                                                         payload,
+                                                         debug=self.__debug)
+        except Exception as e:
+            pending.error = e
+            raise
+        finally:
+            with self.__stateLock:
+                if self.__inflight.get(key) is pending:
+                    del self.__inflight[key]
+                if pending.error is None:
+                    self.__cache[key] = (pending.started, pending.data)
+            pending.event.set()
+        return pending.data, clock.monotonic() - pending.started
+
+    def read(self, deviceId, address, numWords, maxAge=0):
+        """
+        Return a (data, age) tuple for the requested registers where data is
+        the same as what commander.transact returns.
+        """
+        payload = [(0xFF00 & address) >> 8, 0x00FF & address, 0x0, numWords]
+        reply, age = self.request(deviceId,
+                                  commander.readFunction(address),
+                                  payload,
+                                  maxAge)
+        # Strip off the byte count
+        return reply[1:], age
+
+    def close(self):
+        self.__transport.close()
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+    """
+    Handles one client connection.  Requests are answered in the order they
+    arrive on the connection.
+    """
+    def handle(self):
+        bus = self.server.bus
+        for line in iter(self.rfile.readline, ""):
+            try:
+                request = json.loads(line)
+                data, age = bus.read(int(request["device"]),
+                                     int(request["address"]),
+                                     int(request.get("words", 1)),
+                                     float(request.get("maxAge", 0)))
+                reply = {"ok": True, "data": list(data), "age": age}
+            except Exception as e:
+                reply = {"ok": False, "error": str(e)}
+            self.wfile.write(json.dumps(reply) + "\n")
+            self.wfile.flush()
+
+
+class ArbiterServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, bus):
+        """
+        Serve the given Bus on a Unix socket at path.  A stale socket file
+        left behind by a previous run is removed first.  Raises RuntimeError
+        if another arbiter is still serving on path, taking its socket over
+        would leave two processes driving the bus.
+        """
+        if os.path.exists(path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(path)
+            except socket.error:
+                # Nobody listens on it, the previous run died
+                os.unlink(path)
+            else:
+                raise RuntimeError("An arbiter is already serving on %s" %
+                                   path)
+            finally:
+                probe.close()
+        self.bus = bus
+        SocketServer.UnixStreamServer.__init__(self, path, _Handler)
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+
+
+class ArbiterClient(object):
+    def __init__(self, path=DEFAULT_SOCKET):
+        """
+        Client side of the arbiter protocol.  One client should be used per
+        thread, the connection is not shared.
+        """
+        self.__sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.__sock.connect(path)
+        self.__file = self.__sock.makefile("rwb")
+
+    def read(self, deviceId, address, numWords, maxAge=0):
+        """
+        Return a (data, age) tuple, see Bus.read
+        """
+        request = {"device": deviceId,
+                   "address": address,
+                   "words": numWords,
+                   "maxAge": maxAge}
+        self.__file.write(json.dumps(request) + "\n")
+        self.__file.flush()
+        reply = json.loads(self.__file.readline())
+        if not reply["ok"]:
+            raise RuntimeError(reply["error"])
+        return bytearray(reply["data"]), reply["age"]
+
+    def communicate(self, deviceId, address, register, maxAge=0):
+        """
+        Same as commander.communicate but goes through the arbiter.
+        """
+        if commander.isBitAddress(address):
+            data, _ = self.read(deviceId, address, 1, maxAge)
+            value = commander.unpackBits(data, 1)[0]
+        else:
+            data, _ = self.read(deviceId, address, register.numWords, maxAge)
+            value = commander.combineBytes(data)
+        return register.unit(address, value, register.times)
+
+    def close(self):
+        self.__file.close()
+        self.__sock.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Share one controller bus")
+    parser.add_argument("--port", default=None, help="Serial port to own")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET,
+                        help="Unix socket to serve clients on")
+    args = parser.parse_args()
+
+    bus = Bus(commander.getRs485(args.port, exclusive=True))
+    try:
+        server = ArbiterServer(args.socket, bus)
+    except Exception:
+        bus.close()
+        raise
+    try:
+        server.serve_forever()
+    finally:
+        # Close the port and the socket regardless of errors
+        server.server_close()
+        bus.close()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+#
+# Capture bus traffic to a file and play it back later.
+#
+# Capture is a transport attempt hook, attach it to a serial (or any RTU)
+# transport with addAttemptHook and every request and reply frame is written to
+# a compact binary file, including the tries that failed and were sent again.
+# Those timeouts, bad CRCs and late replies are often what a capture from the
+# field is taken for.
+# ReplayTransport reads such a file and answers requests with the recorded
+# replies, either at the recorded pace or as fast as it can.  Replies go
+# through the same framing, CRC and decoding code as live traffic, so a capture
+# from a misbehaving unit reproduces decoder problems in the lab and doubles as
+# a benchmark of everything above the wire.
+#
+# The file is a header followed by one record per try:
+#
+#   header: MAGIC, then ">d" wall clock time the capture started
+#   record: ">dfHH" seconds since the start the request was sent, seconds the
+#           reply took, request length, reply length, then the request and
+#           reply bytes.  A reply length of 0 means nothing came back.
+import argparse
+import struct
+import time
+
+import clock
+import commander
+import mappings
+import transport
+
+MAGIC = "MPPTCAP1"
+_HEADER = struct.Struct(">d")
+_RECORD = struct.Struct(">dfHH")
+
+
+class Capture(object):
+    def __init__(self, path, flushInterval=5):
+        """
+        Transport attempt hook that writes every try of every transaction to
+        a capture file.
+
+        @param path: File to write, it is replaced if it exists
+        @param flushInterval: Seconds after which the records written so far
+                              are flushed to the file, so a crash loses at
+                              most this much of the capture
+        """
+        self.file = open(path, "wb")
+        self.file.write(MAGIC)
+        self.file.write(_HEADER.pack(time.time()))
+        self.start = clock.monotonic()
+        self.flushInterval = flushInterval
+        self.records = 0
+        self.__lastFlush = self.start
+
+    def __call__(self, event):
+        if event.request is None:
+            return
+        reply = event.reply or bytearray()
+        sent = clock.monotonic() - event.latency - self.start
+        self.file.write(_RECORD.pack(sent,
+                                     event.latency,
+                                     len(event.request),
+                                     len(reply)))
+        self.file.write(bytes(event.request))
+        self.file.write(bytes(reply))
+        self.records += 1
+        now = clock.monotonic()
+        if now - self.__lastFlush >= self.flushInterval:
+            self.file.flush()
+            self.__lastFlush = now
+
+    def close(self):
+        self.file.close()
+
+
+def readCapture(path):
+    """
+    Return (start time, list of (sent, latency, request, reply) tuples) from
+    a capture file.
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise RuntimeError("Not a capture file: %s" % path)
+    offset = len(MAGIC)
+    start, = _HEADER.unpack_from(data, offset)
+    offset += _HEADER.size
+    records = []
+    while offset < len(data):
+        sent, latency, requestLen, replyLen = _RECORD.unpack_from(data, offset)
+        offset += _RECORD.size
+        request = bytearray(data[offset:offset + requestLen])
+        offset += requestLen
+        reply = bytearray(data[offset:offset + replyLen])
+        offset += replyLen
+        records.append((sent, latency, request, reply))
+    return start, records
+
+
+class ReplayTransport(transport.RtuTransport):
+    def __init__(self, path, realtime=False, loop=False):
+        """
+        Answer requests with the replies from a capture file, in order.
+
+        @param path: The capture file
+        @param realtime: Wait for the recorded time before each reply instead
+                         of answering right away
+        @param loop: Start over at the end of the file instead of timing out
+        """
+        self.start, self.records = readCapture(path)
+        self.realtime = realtime
+        self.loop = loop
+        self.position = 0
+        self.__reply = bytearray()
+        self.__replayStart = None
+
+    def _write(self, frame):
+        if self.position >= len(self.records):
+            if not self.loop or not self.records:
+                self.__reply = bytearray()
+                return
+            self.position = 0
+            self.__replayStart = None
+        sent, latency, request, reply = self.records[self.position]
+        self.position += 1
+        if request != frame:
+            raise transport.FrameError("Replay out of step at record %d" %
+                                       (self.position - 1))
+        if self.realtime:
+            now = clock.monotonic()
+            if self.__replayStart is None:
+                self.__replayStart = now - sent
+            delay = self.__replayStart + sent + latency - now
+            if delay > 0:
+                time.sleep(delay)
+        self.__reply = reply
+
+    def _read(self, count):
+        data = self.__reply[:count]
+        self.__reply = self.__reply[count:]
+        return data
+
+
+def parseRequest(frame):
+    """
+    Return (deviceId, function, address, count) of an RTU request frame.
+    """
+    address, count = struct.unpack(">HH", bytes(frame[2:6]))
+    return frame[0], frame[1], address, count
+
+
+def replay(link, records, debug=False):
+    """
+    Drive the recorded requests through commander the way the live code
+    would.  Returns the number of transactions and the number that failed.
+    """
+    failed = 0
+    for _, _, request, _ in records:
+        deviceId, function, address, count = parseRequest(request)
+        register = mappings.REGISTERS.get(address)
+        try:
+            if function == 0x10:
+                values = [request[7 + 2 * i] << 8 | request[8 + 2 * i]
+                          for i in xrange(count)]
+                commander.writeRegisters(link, deviceId, address, values,
+                                         debug)
+            elif register is not None and count == register.numWords:
+                result = commander.communicate(link, deviceId, address,
+                                               register, debug)
+                if debug:
+                    print "%s \"%s\": %s" % (hex(address), register.name,
+                                             result)
+            elif commander.isBitAddress(address):
+                commander.readBits(link, deviceId, address, count, debug)
+            else:
+                commander.transact(link, deviceId, address, count, debug)
+        except (RuntimeError, ValueError):
+            failed += 1
+    return len(records), failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Capture and replay traffic")
+    sub = parser.add_subparsers(dest="command")
+    record = sub.add_parser("record", help="Sweep every register and record")
+    record.add_argument("path")
+    record.add_argument("--port", default=None)
+    record.add_argument("--device", type=int, default=1)
+    record.add_argument("--sweeps", type=int, default=1)
+    play = sub.add_parser("replay", help="Play a capture through the decoders")
+    play.add_argument("path")
+    play.add_argument("--realtime", action="store_true",
+                      help="Keep the recorded pace instead of full speed")
+    play.add_argument("--repeat", type=int, default=1)
+    play.add_argument("--debug", action="store_true")
+    args = parser.parse_args()
+
+    if args.command == "record":
+        link = transport.SerialTransport(commander.getRs485(args.port))
+        capture = Capture(args.path)
+        link.addAttemptHook(capture)
+        try:
+            for _ in xrange(args.sweeps):
+                commander.readBitRanges(link, args.device)
+                for addr, reg in sorted(mappings.REGISTERS.iteritems()):
+                    if not commander.isBitAddress(addr):
+                        commander.communicate(link, args.device, addr, reg)
+        finally:
+            capture.close()
+            link.close()
+        print "Recorded %d tries" % capture.records
+    else:
+        link = ReplayTransport(args.path, realtime=args.realtime, loop=True)
+        start = time.time()
+        total = failed = 0
+        for _ in xrange(args.repeat):
+            count, bad = replay(link, link.records, args.debug)
+            total += count
+            failed += bad
+        elapsed = time.time() - start
+        print "%d transactions (%d failed) in %.3f s, %.0f per second" % (
+            total, failed, elapsed, total / elapsed if elapsed else 0)
@@ -0,0 +1,52 @@
+# Module with the time keeping used to stamp transactions.
+#
+# Python 2 has no time.monotonic so on Linux it is read straight from
+# clock_gettime.  Wall clock time can jump (NTP, the user, DST on some systems)
+# which would wreck energy integration and latency numbers, the monotonic clock
+# can not.
+import ctypes
+import ctypes.util
+import os
+import time
+
+
+def _linuxMonotonic():
+    """
+    Return a monotonic() function built on clock_gettime(CLOCK_MONOTONIC) or
+    None if it is not available.
+    """
+    class _Timespec(ctypes.Structure):
+        _fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+    try:
+        librt = ctypes.CDLL(ctypes.util.find_library("rt") or "librt.so.1",
+                            use_errno=True)
+        clock_gettime = librt.clock_gettime
+    except (OSError, AttributeError):
+        return None
+    clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(_Timespec)]
+    # From <linux/time.h>
+    CLOCK_MONOTONIC = 1
+
+    def monotonic():
+        t = _Timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return t.tv_sec + t.tv_nsec * 1e-9
+    return monotonic
+
+
+if hasattr(time, "monotonic"):
+    monotonic = time.monotonic
+else:
+    # Falls back to the wall clock where there is nothing better
+    monotonic = _linuxMonotonic() or time.time
+
+
+def toWall(stamp):
+    """
+    Convert a monotonic() stamp taken in this process to wall clock time
+    (seconds since the epoch).
+    """
+    return time.time() - (monotonic() - stamp)
@@ -24,12 +24,24 @@ import serial.rs485
 import sys
 import time
 
+import linkprofile
 import mappings
+import transport
 
 PLATFORM = platform.platform()
 
 
-def getRs485(port=None):
+def defaultPort():
+    """
+    Name of the serial port used when none is given.
+    """
+    if PLATFORM.startswith("Linux"):
+        return '/dev/ttyXRUSB0'
+    return "COM4"
+
+
+def getRs485(port=None, baudrate=None, timeout=None, interByteTimeout=None,
+             exclusive=False):
     """
     Return the opened serial port to be used for communication.
 
@@ -37,34 +49,64 @@ def getRs485(port=None):
     It still may be possible to use this if it is used like it is on Linux.
 
     On Linux the driver hard-codes the port to rs485 instead of setting it here.
+
+    Settings that are not given come from the profile linktune saved for the
+    port, or are 115200 baud and a one second timeout if it was never
+    calibrated.
+
+    @param baudrate: Baud rate of the link
+    @param timeout: Seconds to wait for a reply
+    @param interByteTimeout: Seconds of silence inside a reply that end it
+    @param exclusive: Lock the port so no other process can open it, for
+                      daemons that own the bus (pyserial 3.3 and up, POSIX
+                      only; ports on Windows are always exclusive)
     """
+    if not port:
+        port = defaultPort()
+    profile = linkprofile.portProfile(port)
+    if profile is not None:
+        if baudrate is None:
+            baudrate = profile.baudrate
+        if timeout is None:
+            timeout = profile.timeout
+        if interByteTimeout is None:
+            interByteTimeout = profile.interByteTimeout
+    if baudrate is None:
+        baudrate = 115200
+    if timeout is None:
+        timeout = 1
+
+    options = {}
+    if exclusive and os.name == "posix":
+        options["exclusive"] = True
+
     ser = None
     if PLATFORM.startswith("Linux"):
-        if not port:
-            port = '/dev/ttyXRUSB0'
         ser = serial.Serial(port=port,
-                            baudrate=115200,
-                            timeout=1, # set a timeout value, None for waiting forever
+                            baudrate=baudrate,
+                            timeout=timeout, # set a timeout value, None for waiting forever
+                            inter_byte_timeout=interByteTimeout,
                             parity=serial.PARITY_NONE, # enable parity checking
                             stopbits=serial.STOPBITS_ONE, # number of stop bits
                             bytesize=serial.EIGHTBITS, # number of data bits
                             xonxoff=0, # enable software flow control
-                            rtscts=0) # enable RTS/CTS flow control
+                            rtscts=0, # enable RTS/CTS flow control
+                            **options)
         # On linux the rs485 settings are not used.  The driver has the port
         # hard coded to rs485. That driver can be found here along with another
         # python implementation that does something similar to this one.
         # https://github.com/kasbert/epsolar-tracer
     else:
-        if not port:
-            port = "COM4"
         ser = serial.Serial(port=port,
-                            baudrate=115200,
-                            timeout=1, # set a timeout value, None for waiting forever
+                            baudrate=baudrate,
+                            timeout=timeout, # set a timeout value, None for waiting forever
+                            inter_byte_timeout=interByteTimeout,
                             parity=serial.PARITY_NONE, # enable parity checking
                             stopbits=serial.STOPBITS_ONE, # number of stop bits
                             bytesize=serial.EIGHTBITS, # number of data bits
                             xonxoff=0, # enable software flow control
-                            rtscts=1) # enable RTS/CTS flow control
+                            rtscts=1, # enable RTS/CTS flow control
+                            **options)
         ser.rs485_mode = serial.rs485.RS485Settings()
     return ser
 
@@ -106,69 +148,164 @@ def combineBytes(data):
     return combined
 
 
-def communicate(ser, deviceId, address, register, debug=False):
+# Bit number to value for every possible byte, least significant bit first
+# which is the order coils and discrete inputs are packed in.
+BITS = tuple(tuple((byte >> bit) & 0x1 for bit in xrange(8))
+             for byte in xrange(256))
+
+
+def readFunction(address):
     """
-    Used to send and receive from the MPPT controller
+    Return the Modbus function code used to read the given address.
+    """
+    # Command changes based on register address.  This has to do with coils
+    # vs discrete inputs vs input registers vs holding registers.
+    if address >= 0x1000 and address < 0x2000:
+        return 0x04
+    elif address >= 0x2000 and address < 0x3000:
+        return 0x02
+    elif address >= 0x3000 and address < 0x9000:
+        return 0x04
+    elif address >= 0x9000:
+        return 0x03
+    elif address < 0x15:
+        return 0x01
+    raise RuntimeError("Inapropriate register address")
 
-    @param ser: The serial connection used to communicate
+
+def isBitAddress(address):
+    """
+    True if the address is a coil or discrete input rather than a register.
+    """
+    return readFunction(address) in (0x01, 0x02)
+
+
+def unpackBits(data, count):
+    """
+    Turn the packed bytes of a coil or discrete input reply into a list of
+    count ints, one per bit.
+    """
+    bits = []
+    for byte in data:
+        bits.extend(BITS[byte])
+    return bits[:count]
+
+
+def transact(ser, deviceId, address, numWords, debug=False):
+    """
+    Perform one read transaction on the bus and return the raw data bytes
+
+    The reply is returned with the header and CRC stripped off so that it can
+    be handed to combineBytes or cached as-is by callers that share the bus.
+
+    @param ser: The serial connection or transport.Transport used to
+                communicate
     @param deviceId: The ID number of the device on the bus that we want to
                      communicate with
     @param address: The address of the register that we will be querying
-    @param register: The Register struct that we are passing
+    @param numWords: The number of 16 bit words (registers) to read, or the
+                     number of bits for coils and discrete inputs
     """
     # Split the value into low and high bytes
     low = 0x00FF & address
     high = (0xFF00 & address) >> 8
 
-    # Command changes based on register address.  This has to do with coils
-    # vs input registers vs realtime status etc.
-    command = None
-    if address >= 0x1000 and address < 0x3000:
-        command = 0x04
-    elif address >= 0x3000 and address < 0x9000:
-        command = 0x04
-    elif address >= 0x9000:
-        command = 0x03
-    elif address < 0x15:
-        command = 0x01
-    else:
-        raise RuntimeError("Inapropriate register address")
-
-    byteMessage = [deviceId, command, high, low, 0x0, register.numWords]
-
-    addCRC(byteMessage) # This puts the CRC on the message in situ
-
-    # If we have debug on, print out what we send and receive
-    if debug:
-        message = []
-        for m in byteMessage:
-            message.append(str(hex(m)))
-        print "\tSending:", " ".join(message)
-
-    ser.write(byteMessage)
-    ser.flush()
-
-    rec = bytearray()
-    for i in xrange(100):
-        r = ser.read(1)
-        if r:
-            rec.append(r)
-        else:
-            # Received empty, call it done
-            break
-
-    # If we have debug on, print out what we send and receive
-    if debug:
-        print "\tReceive:",
-        for m in rec:
-            print '0x%01x' % m,
-        print
-
-    # Strip off the header and CRC then convert it using the unit function 
-    # pointer
-    data = rec[3:-2] 
-
-    # Convert to communication Results
+    payload = [high, low, 0x0, numWords]
+    reply = transport.wrap(ser).transact(deviceId,
+                                         readFunction(address),
+                                         payload,
+                                         debug=debug)
+
+    # Strip off the byte count
+    return reply[1:]
+
+
+def readBits(ser, deviceId, address, count, debug=False):
+    """
+    Read count coils or discrete inputs starting at address in one
+    transaction and return them as a list of ints.
+    """
+    data = transact(ser, deviceId, address, count, debug=debug)
+    return unpackBits(data, count)
+
+
+def readBitValues(ser, deviceId, registers=None, debug=False):
+    """
+    Read every range in mappings.BIT_RANGES with one transaction each and
+    return a dictionary of address to bit value (0 or 1) for the addresses
+    that are in registers (all of mappings.REGISTERS by default).  Ranges
+    with nothing wanted in them are not read at all.
+    """
+    if registers is None:
+        registers = mappings.REGISTERS
+    link = transport.wrap(ser)
+    values = {}
+    for first, count in mappings.BIT_RANGES:
+        wanted = [addr for addr in xrange(first, first + count)
+                  if addr in registers]
+        if not wanted:
+            continue
+        bits = readBits(link, deviceId, first, count, debug=debug)
+        for addr in wanted:
+            values[addr] = bits[addr - first]
+    return values
+
+
+def readBitRanges(ser, deviceId, registers=None, debug=False):
+    """
+    Same as readBitValues but return a dictionary of address to Result.
+    """
+    if registers is None:
+        registers = mappings.REGISTERS
+    values = readBitValues(ser, deviceId, registers, debug)
+    results = {}
+    for addr, value in values.iteritems():
+        register = registers[addr]
+        results[addr] = register.unit(addr, value, register.times)
+    return results
+
+
+def writeRegisters(ser, deviceId, address, values, debug=False):
+    """
+    Write consecutive holding registers in one transaction (function 0x10).
+
+    Registers that the controller wants written together, like the real time
+    clock, have to go through here rather than one at a time.
+
+    @param ser: The serial connection or transport.Transport used to
+                communicate
+    @param deviceId: The ID number of the device on the bus that we want to
+                     communicate with
+    @param address: The address of the first register to write
+    @param values: The 16 bit values to write starting at address
+    """
+    payload = [(0xFF00 & address) >> 8, 0x00FF & address,
+               0x0, len(values), 2 * len(values)]
+    for value in values:
+        payload.append((0xFF00 & value) >> 8)
+        payload.append(0x00FF & value)
+    transport.wrap(ser).transact(deviceId, 0x10, payload, debug=debug)
+
+
+def communicate(ser, deviceId, address, register, debug=False):
+    """
+    Used to send and receive from the MPPT controller
+
+    @param ser: The serial connection or transport.Transport used to
+                communicate
+    @param deviceId: The ID number of the device on the bus that we want to
+                     communicate with
+    @param address: The address of the register that we will be querying
+    @param register: The Register struct that we are passing
+    """
+    if isBitAddress(address):
+        # Coils and discrete inputs come back one bit each, packed into bytes
+        value = readBits(ser, deviceId, address, 1, debug=debug)[0]
+        return register.unit(address, value, register.times)
+
+    data = transact(ser, deviceId, address, register.numWords, debug=debug)
+
+    # Convert to communication Results using the unit function pointer
     return register.unit(address, combineBytes(data), register.times)
 
 
@@ -184,7 +321,14 @@ if __name__ == "__main__":
 
         # Query the device 10 times and exit
         for _ in xrange(1):
+            # Coils and discrete inputs a whole range at a time
+            results = readBitRanges(ser, deviceId, debug=False)
+            for addr, result in sorted(results.iteritems()):
+                reg = mappings.REGISTERS[addr]
+                print "%s \"%s\": %s" % (hex(addr), reg.name, result)
             for addr, reg in sorted(mappings.REGISTERS.iteritems()):
+                if isBitAddress(addr):
+                    continue
                 result = communicate(ser, deviceId, addr, reg, debug=False)
                 print "%s \"%s\": %s" % (hex(addr), reg.name, result)
             time.sleep(1)
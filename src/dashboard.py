@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+#
+# Small web dashboard for looking at controllers from a browser.
+#
+# One poller.BusWorker owns the link and sweeps the registers.  Changed values
+# go to a Broadcaster, which turns every change into one Server-Sent Events
+# message and hands that same string to every connected browser, so more
+# viewers cost neither bus traffic nor encoding.  A browser that connects
+# first gets a snapshot of everything seen so far, then only the deltas.  A
+# browser that falls too far behind is dropped and reconnects on its own.
+#
+# Run it against the simulator to try it without a controller:
+#
+#   python dashboard.py --simulate
+import argparse
+import BaseHTTPServer
+import json
+import Queue
+import random
+import SocketServer
+import threading
+import time
+
+import commander
+import mappings
+import poller
+import simulator
+
+# Seconds between comment lines that keep idle connections open through
+# proxies and let the server notice browsers that went away
+KEEPALIVE = 15
+
+PAGE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<meta name="viewport" content="width=device-width, initial-scale=1">
+<title>mpptCommander</title>
+<style>
+body { font-family: sans-serif; margin: 0.5em; }
+table { border-collapse: collapse; width: 100%; }
+td { border-bottom: 1px solid #ddd; padding: 0.3em; }
+td.value { text-align: right; white-space: nowrap; }
+#status { color: #888; }
+.changed { background: #ffc; }
+</style>
+</head>
+<body>
+<p id="status">connecting</p>
+<table id="values"></table>
+<script>
+var rows = {};
+var table = document.getElementById("values");
+var statusLine = document.getElementById("status");
+
+function show(key, item) {
+    var row = rows[key];
+    if (!row) {
+        var keys = Object.keys(rows).concat([key]).sort();
+        row = table.insertRow(keys.indexOf(key));
+        row.insertCell(0).textContent = item.device + " " + item.name;
+        row.insertCell(1).className = "value";
+        rows[key] = row;
+    }
+    var results = item.results.map(function (r) {
+        return r.value + " " + r.unit;
+    });
+    row.cells[1].textContent = results.join(", ");
+    row.className = "changed";
+    setTimeout(function () { row.className = ""; }, 1000);
+}
+
+function update(e) {
+    var data = JSON.parse(e.data);
+    for (var key in data.values) {
+        show(key, data.values[key]);
+    }
+    statusLine.textContent = new Date(data.time * 1000).toLocaleString();
+}
+
+var source = new EventSource("events");
+source.addEventListener("snapshot", update);
+source.addEventListener("delta", update);
+source.onerror = function () { statusLine.textContent = "reconnecting"; };
+</script>
+</body>
+</html>
+"""
+
+
+def resultItem(deviceId, address, result):
+    """
+    JSON friendly form of what a register unit function returned.
+    """
+    results = result if isinstance(result, list) else [result]
+    return {"device": deviceId,
+            "address": "0x%04x" % address,
+            "name": mappings.REGISTERS[address].name,
+            "results": [{"unit": r.unit, "value": r.value} for r in results]}
+
+
+class Broadcaster(object):
+    def __init__(self, maxQueued=100):
+        """
+        Fan Server-Sent Events messages out to any number of clients.
+
+        @param maxQueued: Messages a client may fall behind before it is
+                          dropped
+        """
+        self.maxQueued = maxQueued
+        self.lock = threading.Lock()
+        self.eventId = 0
+        self.state = {}
+        self.__clients = []
+        self.__snapshot = None
+
+    def __len__(self):
+        with self.lock:
+            return len(self.__clients)
+
+    @staticmethod
+    def format(eventId, event, data):
+        return "id: %d\nevent: %s\ndata: %s\n\n" % (
+            eventId, event, json.dumps(data, sort_keys=True, default=str))
+
+    def subscribe(self):
+        """
+        Return a Queue.Queue that gets every message as a string, starting
+        with a snapshot of the current state.
+        """
+        client = Queue.Queue(self.maxQueued)
+        with self.lock:
+            if self.__snapshot is None:
+                self.__snapshot = self.format(self.eventId,
+                                              "snapshot",
+                                              {"time": time.time(),
+                                               "values": self.state})
+            client.put(self.__snapshot)
+            self.__clients.append(client)
+        return client
+
+    def unsubscribe(self, client):
+        with self.lock:
+            if client in self.__clients:
+                self.__clients.remove(client)
+
+    def subscribed(self, client):
+        with self.lock:
+            return client in self.__clients
+
+    def publish(self, changes, when=None):
+        """
+        Send one delta event to every client.
+
+        @param changes: Dictionary of key to resultItem of what changed
+        """
+        if when is None:
+            when = time.time()
+        with self.lock:
+            self.state.update(changes)
+            self.eventId += 1
+            self.__snapshot = None
+            message = self.format(self.eventId,
+                                  "delta",
+                                  {"time": when, "values": changes})
+            for client in list(self.__clients):
+                try:
+                    client.put_nowait(message)
+                except Queue.Full:
+                    self.__clients.remove(client)
+
+
+class DeltaPublisher(threading.Thread):
+    def __init__(self, samples, broadcaster):
+        """
+        Turn poller.Samples into delta events, one per batch of Samples that
+        are waiting when it looks.
+
+        @type samples: Queue.Queue
+        @type broadcaster: Broadcaster
+        """
+        threading.Thread.__init__(self, name="DeltaPublisher")
+        self.daemon = True
+        self.samples = samples
+        self.broadcaster = broadcaster
+        self.__last = {}
+
+    def run(self):
+        while True:
+            batch = [self.samples.get()]
+            try:
+                while True:
+                    batch.append(self.samples.get_nowait())
+            except Queue.Empty:
+                pass
+            changes = {}
+            for sample in batch:
+                if sample.result is None:
+                    continue
+                key = "%d/0x%04x" % (sample.deviceId, sample.address)
+                item = resultItem(sample.deviceId, sample.address,
+                                  sample.result)
+                if self.__last.get(key) != item:
+                    self.__last[key] = item
+                    changes[key] = item
+            if changes:
+                self.broadcaster.publish(changes, batch[-1].time)
+
+
+class _DashboardHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path == "/":
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html; charset=utf-8")
+            self.send_header("Content-Length", str(len(PAGE)))
+            self.end_headers()
+            self.wfile.write(PAGE)
+        elif path == "/events":
+            self.__stream()
+        else:
+            self.send_error(404)
+
+    def __stream(self):
+        broadcaster = self.server.broadcaster
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        client = broadcaster.subscribe()
+        try:
+            while True:
+                try:
+                    message = client.get(timeout=KEEPALIVE)
+                except Queue.Empty:
+                    if not broadcaster.subscribed(client):
+                        break
+                    message = ":\n\n"
+                self.wfile.write(message)
+                self.wfile.flush()
+        except IOError:
+            # The browser went away
+            pass
+        finally:
+            broadcaster.unsubscribe(client)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class DashboardServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, broadcaster):
+        """
+        @param address: The (host, port) tuple to listen on
+        @type broadcaster: Broadcaster
+        """
+        self.broadcaster = broadcaster
+        BaseHTTPServer.HTTPServer.__init__(self, address, _DashboardHandler)
+
+
+def start(link, deviceIds, registers=None, interval=5, maxQueued=100):
+    """
+    Start the shared poller and return its Broadcaster.
+
+    @param link: The serial connection or transport.Transport to poll
+    """
+    if registers is None:
+        registers = mappings.REGISTERS
+    samples = Queue.Queue(1000)
+    broadcaster = Broadcaster(maxQueued)
+    poller.BusWorker("dashboard", link, deviceIds, registers, samples,
+                     interval).start()
+    DeltaPublisher(samples, broadcaster).start()
+    return broadcaster
+
+
+def _wander(controller, interval):
+    """
+    Keep moving a few values of a SimulatedController so the simulated
+    dashboard has something to show.
+    """
+    while True:
+        controller.setValue(0x3100, random.randint(1700, 1900), 1)
+        controller.setValue(0x3101, random.randint(100, 300), 1)
+        controller.setValue(0x3104, random.randint(1290, 1310), 1)
+        time.sleep(interval)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Web dashboard")
+    parser.add_argument("--port", default=None, help="Serial port to poll")
+    parser.add_argument("--device", type=int, action="append",
+                        help="Device id, can be given more than once")
+    parser.add_argument("--listen", default="0.0.0.0")
+    parser.add_argument("--http-port", type=int, default=8080)
+    parser.add_argument("--interval", type=float, default=5)
+    parser.add_argument("--simulate", action="store_true",
+                        help="Poll a simulated controller instead")
+    args = parser.parse_args()
+
+    deviceIds = args.device or [1]
+    if args.simulate:
+        controllers = dict((deviceId, simulator.SimulatedController())
+                           for deviceId in deviceIds)
+        for controller in controllers.values():
+            wander = threading.Thread(target=_wander,
+                                      args=(controller, args.interval))
+            wander.daemon = True
+            wander.start()
+        link = simulator.SimulatedTransport(controllers)
+    else:
+        link = commander.getRs485(args.port)
+
+    server = DashboardServer((args.listen, args.http_port),
+                             start(link, deviceIds, interval=args.interval))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        link.close()
@@ -0,0 +1,188 @@
+# Module for energy accounting from the power and energy registers.
+#
+# The controller reports instantaneous PV, battery and load power (0x3102,
+# 0x3106, 0x310E) and keeps its own kWh counters (0x3304-0x3312).  EnergyAccount
+# integrates the power readings between samples, keeps daily, monthly and yearly
+# totals and checks its numbers against the controller counters.  Every call
+# does a fixed amount of work so it is fine to feed it from inside the polling
+# loop.
+import datetime
+from collections import namedtuple
+
+PV_POWER = 0x3102
+BATTERY_POWER = 0x3106
+LOAD_POWER = 0x310E
+
+# Register address to channel name for the power registers
+CHANNELS = {PV_POWER: "pv",
+            BATTERY_POWER: "battery",
+            LOAD_POWER: "load"}
+
+# Register address to (channel, period) for the controller energy counters.
+# Consumed energy is what went out to the load, generated energy is what came
+# in from the array.
+COUNTERS = {0x3304: ("load", "day"),
+            0x3306: ("load", "month"),
+            0x3308: ("load", "year"),
+            0x330A: ("load", "total"),
+            0x330C: ("pv", "day"),
+            0x330E: ("pv", "month"),
+            0x3310: ("pv", "year"),
+            0x3312: ("pv", "total")}
+
+# The counters have a resolution of 0.01 kWh.  A drop of more than half a step
+# is a reset, anything less is noise.
+RESET_TOLERANCE = 0.005
+
+
+class Reconciliation(namedtuple("Reconciliation", ["address",
+                                                   "channel",
+                                                   "period",
+                                                   "integrated",
+                                                   "device"])):
+    """
+    @type address: int
+    @param address: The counter register address
+    @type channel: string
+    @param channel: "pv" or "load"
+    @type period: string
+    @param period: "day", "month", "year" or "total"
+    @type integrated: float
+    @param integrated: What the counter should read according to the
+                       integrated power, in kWh
+    @type device: float
+    @param device: What the counter last read, in kWh
+    """
+    __slots__ = ()
+
+    @property
+    def difference(self):
+        """
+        device - integrated in kWh.  Positive means the controller counted
+        more energy than we did.
+        """
+        return self.device - self.integrated
+
+
+class _Channel(object):
+    """
+    Trapezoidal integration of one power register.
+    """
+    __slots__ = ("time", "watts", "wh")
+
+    def __init__(self):
+        self.time = None
+        self.watts = None
+        self.wh = 0.0
+
+
+class _Counter(object):
+    """
+    Last value of one controller counter and the integrated energy it lined
+    up with when we started tracking it (or it last reset).
+    """
+    __slots__ = ("value", "offset", "resets")
+
+    def __init__(self):
+        self.value = None
+        self.offset = 0.0
+        self.resets = 0
+
+
+def _periodKeys(when):
+    """
+    Return the (day, month, year) bucket keys for a wall clock time.
+    """
+    date = datetime.date.fromtimestamp(when)
+    return date, (date.year, date.month), date.year
+
+
+class EnergyAccount(object):
+    def __init__(self, maxGap=300):
+        """
+        @param maxGap: The longest time in seconds between two power samples
+                       that is still integrated.  Longer gaps (the logger was
+                       off, the bus was down) are skipped instead of guessed.
+        """
+        self.maxGap = maxGap
+        self.channels = dict((name, _Channel()) for name in CHANNELS.values())
+        self.counters = dict((addr, _Counter()) for addr in COUNTERS)
+        # (channel, key) -> Wh where key is a date, a (year, month) tuple or a
+        # year.  Only the buckets of the current sample are ever touched.
+        self.buckets = {}
+
+    def observe(self, when, address, value):
+        """
+        Feed one reading.  Registers that are not power or counter registers
+        are ignored so every Result of a sweep can be passed in.
+
+        @param when: Wall clock time the value was sampled, seconds since the
+                     epoch (see clock.toWall for transaction stamps)
+        @param address: The register address
+        @param value: The converted value, Watts or kWh
+        """
+        name = CHANNELS.get(address)
+        if name is not None:
+            self.addPower(when, name, value)
+        elif address in COUNTERS:
+            self.addCounter(address, value)
+
+    def addPower(self, when, name, watts):
+        """
+        Integrate one power reading of the named channel.
+        """
+        channel = self.channels[name]
+        if channel.time is not None:
+            elapsed = when - channel.time
+            if 0 < elapsed <= self.maxGap:
+                wh = (channel.watts + watts) / 2.0 * elapsed / 3600.0
+                channel.wh += wh
+                for key in _periodKeys(channel.time + elapsed / 2.0):
+                    self.buckets[(name, key)] = \
+                        self.buckets.get((name, key), 0.0) + wh
+        channel.time = when
+        channel.watts = watts
+
+    def addCounter(self, address, kwh):
+        """
+        Track one controller counter.  A counter that went down has been
+        cleared by the controller and is lined up with our totals again.
+        """
+        counter = self.counters[address]
+        integrated = self.channels[COUNTERS[address][0]].wh / 1000.0
+        if counter.value is None or kwh < counter.value - RESET_TOLERANCE:
+            if counter.value is not None:
+                counter.resets += 1
+            counter.offset = kwh - integrated
+        counter.value = kwh
+
+    def energy(self, name, key):
+        """
+        Integrated energy in Wh for a channel and a bucket key, e.g.
+        energy("pv", datetime.date.today()) or energy("load", (2026, 10)).
+        """
+        return self.buckets.get((name, key), 0.0)
+
+    def efficiency(self, key):
+        """
+        Battery energy out of the charger over PV energy in for a bucket, or
+        None if nothing came in.
+        """
+        pv = self.energy("pv", key)
+        if pv <= 0:
+            return None
+        return self.energy("battery", key) / pv
+
+    def reconcile(self):
+        """
+        Return a list of Reconciliations, one per counter seen so far.
+        """
+        results = []
+        for addr, counter in sorted(self.counters.iteritems()):
+            if counter.value is None:
+                continue
+            name, period = COUNTERS[addr]
+            integrated = self.channels[name].wh / 1000.0 + counter.offset
+            results.append(Reconciliation(addr, name, period, integrated,
+                                          counter.value))
+        return results
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+#
+# Modbus TCP gateway for controllers on a local RS 485 bus.
+#
+# Remote pollers connect with plain Modbus TCP and get answers at LAN speed.
+# Every connection may pipeline requests, meaning it can send the next request
+# before the reply to the previous one arrived.  Requests on a connection are
+# answered in order, all connections share one arbiter.Bus so reads are
+# serialized, coalesced and answered from the cache when fresh enough.
+import argparse
+import Queue
+import socket
+import SocketServer
+import struct
+import threading
+
+import arbiter
+import commander
+import transport
+
+# Modbus exception code for "gateway target device failed to respond"
+TARGET_NO_RESPONSE = 0x0B
+
+# Modbus exception code for "server device failure"
+DEVICE_FAILURE = 0x04
+
+
+def _readExactly(sock, count):
+    data = bytearray()
+    while len(data) < count:
+        chunk = sock.recv(count - len(data))
+        if not chunk:
+            return None
+        data.extend(chunk)
+    return data
+
+
+class _GatewayHandler(SocketServer.BaseRequestHandler):
+    """
+    One reader (this thread) pulls MBAP frames off the socket and queues them,
+    one writer thread runs them on the bus in order and sends the replies.
+    """
+    def handle(self):
+        pending = Queue.Queue(self.server.pipelineDepth)
+        writer = threading.Thread(target=self.__answer, args=(pending,))
+        writer.daemon = True
+        writer.start()
+        try:
+            while True:
+                head = _readExactly(self.request, 7)
+                if head is None:
+                    break
+                tid, protocol, length, unit = struct.unpack(">HHHB",
+                                                            bytes(head))
+                pdu = _readExactly(self.request, length - 1)
+                if pdu is None or protocol != 0 or not pdu:
+                    break
+                pending.put((tid, unit, pdu))
+        finally:
+            pending.put(None)
+            writer.join()
+
+    def __answer(self, pending):
+        bus = self.server.bus
+        failed = False
+        while True:
+            item = pending.get()
+            if item is None:
+                break
+            if failed:
+                # The client is gone.  Keep taking requests off the queue so
+                # the reader can never block on a full one.
+                continue
+            tid, unit, pdu = item
+            function = pdu[0]
+            try:
+                data, _ = bus.request(unit,
+                                      function,
+                                      pdu[1:],
+                                      self.server.maxAge)
+                reply = bytearray([function]) + data
+            except transport.ModbusError as e:
+                reply = bytearray([function | 0x80, e.code])
+            except transport.FrameError:
+                reply = bytearray([function | 0x80, TARGET_NO_RESPONSE])
+            except Exception:
+                # The port itself failed, e.g. the USB adapter was unplugged
+                reply = bytearray([function | 0x80, DEVICE_FAILURE])
+            frame = bytearray(struct.pack(">HHHB", tid, 0, len(reply) + 1,
+                                          unit))
+            frame.extend(reply)
+            try:
+                self.request.sendall(bytes(frame))
+            except IOError:
+                failed = True
+                try:
+                    self.request.shutdown(socket.SHUT_RDWR)
+                except IOError:
+                    pass
+
+
+class ModbusTcpGateway(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, bus, maxAge=1.0, pipelineDepth=16):
+        """
+        @param address: The (host, port) tuple to listen on
+        @type bus: arbiter.Bus
+        @param bus: The bus the requests are forwarded to
+        @param maxAge: The oldest cached read in seconds that is served
+        @param pipelineDepth: How many requests a client may have outstanding
+                              before the gateway stops reading from it
+        """
+        self.bus = bus
+        self.maxAge = maxAge
+        self.pipelineDepth = pipelineDepth
+        SocketServer.TCPServer.__init__(self, address, _GatewayHandler)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Modbus TCP gateway")
+    parser.add_argument("--port", default=None, help="Serial port to own")
+    parser.add_argument("--listen", default="0.0.0.0")
+    parser.add_argument("--tcp-port", type=int,
+                        default=transport.MODBUS_TCP_PORT)
+    parser.add_argument("--max-age", type=float, default=1.0,
+                        help="Oldest cached read in seconds to serve")
+    args = parser.parse_args()
+
+    bus = arbiter.Bus(commander.getRs485(args.port, exclusive=True))
+    server = ModbusTcpGateway((args.listen, args.tcp_port),
+                              bus,
+                              maxAge=args.max_age)
+    try:
+        server.serve_forever()
+    finally:
+        # Close the port regardless of errors
+        server.server_close()
+        bus.close()
@@ -0,0 +1,358 @@
+#!/usr/bin/env python
+#
+# Compact storage for long term register history.
+#
+# Most registers change slowly or not at all (the settings at 0x9000, the daily
+# min/max at 0x3300) and samples come at a steady rate, so storing every
+# (time, value) pair as is wastes most of an SD card.  Samples are kept per
+# register in blocks:
+#
+#   - times are milliseconds, stored as the delta of the delta from the sample
+#     before, which is 0 (one byte) for a steady poll rate
+#   - values are the raw 16/32 bit words before any conversions scaling and
+#     are stored either as deltas from the previous value or as runs of equal
+#     values, whichever comes out smaller for the block.  Status bit fields
+#     and settings end up as a handful of runs.
+#   - all numbers are zigzag varints
+#
+# The file ends with an index of every block so reading a time range of one
+# register only decodes the blocks that overlap it.  A file that was never
+# closed has no index, it is rebuilt by walking the blocks.  Opening an
+# existing file for writing appends to it.
+import argparse
+import os
+import random
+import struct
+import time
+
+import clock
+
+MAGIC = "MPPTHST1"
+INDEX_MAGIC = "IDX1"
+
+DELTA = 1
+RUNS = 2
+
+# address, count, first time, last time, encoding, payload length
+_BLOCK = struct.Struct(">HIqqBI")
+# address, first time, last time, offset of the block
+_ENTRY = struct.Struct(">HqqQ")
+# offset of the index, number of entries, INDEX_MAGIC
+_TRAILER = struct.Struct(">QI4s")
+
+
+def _putVarint(out, value):
+    """
+    Append value to the bytearray out as a zigzag varint.
+    """
+    value = (value << 1) ^ (value >> 63)
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _varints(data, offset, count):
+    """
+    Decode count zigzag varints from data starting at offset.  Returns the
+    list of values and the offset after the last one.
+    """
+    values = []
+    append = values.append
+    for _ in xrange(count):
+        shift = 0
+        value = 0
+        while True:
+            byte = data[offset]
+            offset += 1
+            value |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                break
+            shift += 7
+        append((value >> 1) ^ -(value & 1))
+    return values, offset
+
+
+def encodeBlock(address, times, values):
+    """
+    Return the bytes of one block.  times are integer milliseconds.
+    """
+    stamps = bytearray()
+    previous = times[0]
+    delta = 0
+    _putVarint(stamps, previous)
+    for t in times[1:]:
+        _putVarint(stamps, (t - previous) - delta)
+        delta = t - previous
+        previous = t
+
+    deltas = bytearray()
+    previous = 0
+    for v in values:
+        _putVarint(deltas, v - previous)
+        previous = v
+
+    runs = bytearray()
+    runCount = 0
+    start = 0
+    for i in xrange(1, len(values) + 1):
+        if i == len(values) or values[i] != values[start]:
+            _putVarint(runs, values[start])
+            _putVarint(runs, i - start)
+            runCount += 1
+            start = i
+
+    if len(runs) < len(deltas):
+        encoding, body = RUNS, bytearray()
+        _putVarint(body, runCount)
+        body.extend(runs)
+    else:
+        encoding, body = DELTA, deltas
+    payload = stamps + body
+    return _BLOCK.pack(address, len(times), times[0], times[-1], encoding,
+                       len(payload)) + bytes(payload)
+
+
+def decodeBlock(header, payload):
+    """
+    Return (times, values) lists from a block header tuple and its payload.
+    """
+    address, count, first, last, encoding, length = header
+    payload = bytearray(payload)
+    deltas, offset = _varints(payload, 0, count)
+    times = []
+    t = 0
+    delta = 0
+    for i, dod in enumerate(deltas):
+        if i == 0:
+            t = dod
+        else:
+            delta += dod
+            t += delta
+        times.append(t)
+
+    if encoding == DELTA:
+        values, _ = _varints(payload, offset, count)
+        total = 0
+        for i, v in enumerate(values):
+            total += v
+            values[i] = total
+    else:
+        (runCount,), offset = _varints(payload, offset, 1)
+        pairs, _ = _varints(payload, offset, 2 * runCount)
+        values = []
+        for i in xrange(0, len(pairs), 2):
+            values.extend([pairs[i]] * pairs[i + 1])
+    return times, values
+
+
+def _readIndex(f):
+    """
+    Return (index, offset the blocks end at) from the trailer of a closed
+    file, None if it has none.
+    """
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    if size < len(MAGIC) + _TRAILER.size:
+        return None
+    f.seek(size - _TRAILER.size)
+    offset, count, magic = _TRAILER.unpack(f.read(_TRAILER.size))
+    if magic != INDEX_MAGIC:
+        return None
+    f.seek(offset)
+    data = f.read(count * _ENTRY.size)
+    return [_ENTRY.unpack_from(data, i * _ENTRY.size)
+            for i in xrange(count)], offset
+
+
+def _scanBlocks(f):
+    """
+    Rebuild the index by walking the blocks of an unclosed file.  Returns
+    (index, offset the last whole block ends at), a partly written last
+    block is left out.
+    """
+    index = []
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    offset = len(MAGIC)
+    while offset + _BLOCK.size <= size:
+        f.seek(offset)
+        header = _BLOCK.unpack(f.read(_BLOCK.size))
+        end = offset + _BLOCK.size + header[5]
+        if end > size:
+            break
+        index.append((header[0], header[2], header[3], offset))
+        offset = end
+    return index, offset
+
+
+def _open(path, mode):
+    f = open(path, mode)
+    if f.read(len(MAGIC)) != MAGIC:
+        f.close()
+        raise RuntimeError("Not a history file: %s" % path)
+    return f
+
+
+class HistoryWriter(object):
+    def __init__(self, path, blockSize=4096, flushInterval=300):
+        """
+        Write a history file.  An existing one is appended to: the index of a
+        closed file is dropped until close() writes a new one and the partly
+        written last block of an unclosed one is cut off.
+
+        @param blockSize: Samples per register that are buffered and then
+                          written as one block
+        @param flushInterval: Seconds after which every buffered sample is
+                              written out and synced, so a power cut loses
+                              at most this much.  Shorter makes smaller
+                              blocks that compress less well.  None to only
+                              write full blocks.
+        """
+        if os.path.exists(path) and os.path.getsize(path):
+            self.file = _open(path, "r+b")
+            self.index, end = _readIndex(self.file) or _scanBlocks(self.file)
+            self.file.seek(end)
+            self.file.truncate()
+        else:
+            self.file = open(path, "wb")
+            self.file.write(MAGIC)
+            self.index = []
+        self.blockSize = blockSize
+        self.flushInterval = flushInterval
+        self.__pending = {}
+        self.__lastFlush = clock.monotonic()
+
+    def append(self, address, when, raw):
+        """
+        @param address: The register address
+        @param when: Wall clock time of the sample in seconds
+        @param raw: The raw register value, before conversions scaling
+        """
+        pending = self.__pending.get(address)
+        if pending is None:
+            pending = self.__pending[address] = ([], [])
+        pending[0].append(int(round(when * 1000)))
+        pending[1].append(raw)
+        if len(pending[0]) >= self.blockSize:
+            self.__flush(address)
+        if self.flushInterval is not None and \
+                clock.monotonic() - self.__lastFlush >= self.flushInterval:
+            self.flush()
+
+    def __flush(self, address):
+        times, values = self.__pending.pop(address)
+        offset = self.file.tell()
+        self.file.write(encodeBlock(address, times, values))
+        self.index.append((address, times[0], times[-1], offset))
+
+    def flush(self):
+        """
+        Write out every buffered sample and sync the file to disk.
+        """
+        for address in sorted(self.__pending):
+            self.__flush(address)
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.__lastFlush = clock.monotonic()
+
+    def close(self):
+        self.flush()
+        offset = self.file.tell()
+        for entry in self.index:
+            self.file.write(_ENTRY.pack(*entry))
+        self.file.write(_TRAILER.pack(offset, len(self.index), INDEX_MAGIC))
+        self.file.close()
+
+
+class HistoryReader(object):
+    def __init__(self, path):
+        self.file = _open(path, "rb")
+        self.index = (_readIndex(self.file) or _scanBlocks(self.file))[0]
+
+    def addresses(self):
+        return sorted(set(entry[0] for entry in self.index))
+
+    def read(self, address, start=None, end=None):
+        """
+        Return a list of (time in seconds, raw value) for one register,
+        optionally only from start to end (seconds, inclusive).
+        """
+        startMs = None if start is None else int(round(start * 1000))
+        endMs = None if end is None else int(round(end * 1000))
+        samples = []
+        for addr, first, last, offset in self.index:
+            if addr != address:
+                continue
+            if (startMs is not None and last < startMs) or \
+                    (endMs is not None and first > endMs):
+                continue
+            self.file.seek(offset)
+            header = _BLOCK.unpack(self.file.read(_BLOCK.size))
+            times, values = decodeBlock(header, self.file.read(header[5]))
+            for t, v in zip(times, values):
+                if (startMs is None or t >= startMs) and \
+                        (endMs is None or t <= endMs):
+                    samples.append((t / 1000.0, v))
+        return samples
+
+    def close(self):
+        self.file.close()
+
+
+def _synthetic(seconds, start):
+    """
+    Yield (address, time, raw) for a day of made up 1 Hz samples that look
+    like a real controller: a PV curve, a slowly moving battery, status words
+    and settings that hardly change.
+    """
+    rng = random.Random(1)
+    battery = 1300
+    for i in xrange(seconds):
+        t = start + i
+        sun = max(0.0, 1 - ((i % 86400) / 43200.0 - 1) ** 2)
+        pv = int(sun * 1800 + rng.randint(0, 3)) if sun else 0
+        battery += rng.choice((-1, 0, 0, 0, 1))
+        yield 0x3100, t, pv
+        yield 0x3102, t, pv * 12
+        yield 0x3104, t, battery
+        yield 0x3110, t, 2500 + (i // 600) % 7
+        yield 0x3200, t, 0
+        yield 0x3201, t, 0x0004 if sun else 0
+        yield 0x3302, t, 1400
+        yield 0x9003, t, 1600
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="History codec benchmark")
+    parser.add_argument("--path", default="/tmp/mpptHistory.bin")
+    parser.add_argument("--seconds", type=int, default=86400)
+    args = parser.parse_args()
+
+    if os.path.exists(args.path):
+        os.remove(args.path)
+    start = time.time()
+    writer = HistoryWriter(args.path)
+    samples = 0
+    for address, when, raw in _synthetic(args.seconds, 1.7e9):
+        writer.append(address, when, raw)
+        samples += 1
+    writer.close()
+    encodeTime = time.time() - start
+    size = os.path.getsize(args.path)
+    # A naive log stores a double time stamp and a 32 bit value per sample
+    print "%d samples, %d bytes, %.2f bytes per sample, ratio %.1f:1" % (
+        samples, size, float(size) / samples, samples * 12.0 / size)
+    print "encode %.0f samples per second" % (samples / encodeTime)
+
+    reader = HistoryReader(args.path)
+    start = time.time()
+    decoded = sum(len(reader.read(addr)) for addr in reader.addresses())
+    decodeTime = time.time() - start
+    print "decode %.0f samples per second" % (decoded / decodeTime)
+
+    start = time.time()
+    hour = reader.read(0x3100, 1.7e9 + 43200, 1.7e9 + 46800)
+    print "one hour of one register: %d samples in %.1f ms" % (
+        len(hour), (time.time() - start) * 1000)
+    reader.close()
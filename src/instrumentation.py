@@ -0,0 +1,160 @@
+# Module with ready made transport hooks for finding slow or flaky buses.
+#
+# Attach any of these to a transport with Transport.addHook:
+#
+#   stats = Stats()
+#   ring = FrameRing(64)
+#   link.addHook(stats)
+#   link.addHook(ring)
+#
+# Stats keeps counters and a latency histogram, FrameRing keeps the raw frames
+# of the last transactions so they can be dumped when something goes wrong.
+import collections
+import sys
+import threading
+import time
+
+import transport
+
+# Upper bounds in seconds of the latency histogram buckets.  The last bucket
+# takes everything slower.
+LATENCY_BUCKETS = (0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0)
+
+
+class Histogram(object):
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        """
+        Fixed bucket histogram.  bounds are the upper bounds of the buckets in
+        increasing order, there is one more bucket for anything above them.
+        """
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.total = 0.0
+        self.count = 0
+        self.maximum = 0.0
+
+    def add(self, value):
+        i = 0
+        for bound in self.bounds:
+            if value <= bound:
+                break
+            i += 1
+        self.counts[i] += 1
+        self.total += value
+        self.count += 1
+        if value > self.maximum:
+            self.maximum = value
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, fraction):
+        """
+        Upper bound of the bucket the given fraction (0-1) of values is in,
+        never more than the maximum seen.
+        """
+        wanted = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= wanted:
+                if i < len(self.bounds):
+                    return min(self.bounds[i], self.maximum)
+                return self.maximum
+        return 0.0
+
+
+class Stats(object):
+    def __init__(self):
+        """
+        Hook that counts transactions, failures, retries and bytes and keeps a
+        latency histogram of the successful ones.
+
+        Failures are counted as timeouts, CRC errors, mismatches (a reply to
+        some other request), Modbus exceptions or port errors (anything the
+        serial port or socket itself raised).
+        """
+        self.lock = threading.Lock()
+        self.transactions = 0
+        self.timeouts = 0
+        self.crcErrors = 0
+        self.mismatches = 0
+        self.exceptions = 0
+        self.portErrors = 0
+        self.retries = 0
+        self.bytesOut = 0
+        self.bytesIn = 0
+        self.latency = Histogram()
+
+    def __call__(self, event):
+        with self.lock:
+            self.transactions += 1
+            self.retries += event.retries
+            self.bytesOut += event.bytesOut
+            self.bytesIn += event.bytesIn
+            if event.error is None:
+                self.latency.add(event.latency)
+            elif isinstance(event.error, transport.CrcError):
+                self.crcErrors += 1
+            elif isinstance(event.error, transport.MismatchError):
+                self.mismatches += 1
+            elif isinstance(event.error, transport.ModbusError):
+                self.exceptions += 1
+            elif isinstance(event.error, transport.FrameError):
+                self.timeouts += 1
+            else:
+                self.portErrors += 1
+
+    def summary(self):
+        """
+        Return a one line human readable summary.
+        """
+        with self.lock:
+            return ("%d transactions, %d timeouts, %d CRC errors, "
+                    "%d mismatches, %d exceptions, %d port errors, "
+                    "%d retries, %d bytes out, %d bytes in, "
+                    "latency mean %.1f ms p95 %.1f ms max %.1f ms" %
+                    (self.transactions, self.timeouts, self.crcErrors,
+                     self.mismatches, self.exceptions, self.portErrors,
+                     self.retries, self.bytesOut,
+                     self.bytesIn, self.latency.mean * 1000,
+                     self.latency.percentile(0.95) * 1000,
+                     self.latency.maximum * 1000))
+
+
+class FrameRing(object):
+    def __init__(self, size=64, dumpOnError=None):
+        """
+        Hook that keeps the last size transactions.  Only references to the
+        frames are stored, formatting happens when dumped.
+
+        @param dumpOnError: A file to dump the ring to whenever a transaction
+                            fails, e.g. sys.stderr.  None to never dump on
+                            its own.
+        """
+        self.events = collections.deque(maxlen=size)
+        self.dumpOnError = dumpOnError
+
+    def __call__(self, event):
+        self.events.append((time.time(), event))
+        if event.error is not None and self.dumpOnError is not None:
+            self.dump(self.dumpOnError)
+
+    def dump(self, out=sys.stdout):
+        """
+        Write every transaction in the ring as hex, oldest first.
+        """
+        for stamp, event in list(self.events):
+            out.write("%.3f dev %d fn 0x%02x %.1f ms%s\n" %
+                      (stamp, event.deviceId, event.function,
+                       event.latency * 1000,
+                       " %s" % event.error if event.error else ""))
+            if event.request is not None:
+                out.write("\t> %s\n" % _hex(event.request))
+            if event.reply is not None:
+                out.write("\t< %s\n" % _hex(event.reply))
+
+
+def _hex(frame):
+    return " ".join("%02x" % b for b in bytearray(frame))
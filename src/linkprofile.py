@@ -0,0 +1,76 @@
+# Module that keeps the serial link profiles linktune calibrates.
+#
+# The profiles live in one JSON file, keyed by port and then device id.  This
+# module imports nothing else from the library so commander.getRs485 can use
+# it without an import cycle.
+import json
+import os
+from collections import namedtuple
+
+PROFILE_PATH = os.path.expanduser("~/.mpptCommander/links.json")
+
+
+class LinkProfile(namedtuple("LinkProfile", ["baudrate",
+                                             "timeout",
+                                             "interByteTimeout",
+                                             "turnaround",
+                                             "calibrated"])):
+    """
+    @type baudrate: int
+    @type timeout: float
+    @param timeout: Seconds to wait for a reply
+    @type interByteTimeout: float
+    @param interByteTimeout: Seconds of silence that end a frame
+    @type turnaround: float
+    @param turnaround: Slowest controller turnaround measured, in seconds
+    @type calibrated: float
+    @param calibrated: Wall clock time of the calibration
+    """
+    __slots__ = ()
+
+
+def _load(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def loadProfile(port, deviceId, path=PROFILE_PATH):
+    """
+    Return the saved LinkProfile of a device, None if there is none.
+    """
+    saved = _load(path).get(port, {}).get(str(deviceId))
+    return LinkProfile(**saved) if saved else None
+
+
+def saveProfile(port, deviceId, profile, path=PROFILE_PATH):
+    profiles = _load(path)
+    profiles.setdefault(port, {})[str(deviceId)] = profile._asdict()
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(profiles, f, indent=2, sort_keys=True)
+    os.rename(tmp, path)
+
+
+def portProfile(port, path=PROFILE_PATH):
+    """
+    Return one LinkProfile that suits every device saved for a port: their
+    baud rate and the longest of their timeouts.  None if there are none.
+    Devices that share a bus must use the same baud rate, the first one is
+    used if they were calibrated to different ones.
+    """
+    saved = _load(path).get(port)
+    if not saved:
+        return None
+    profiles = [LinkProfile(**p) for _, p in sorted(saved.iteritems())]
+    baudrate = profiles[0].baudrate
+    profiles = [p for p in profiles if p.baudrate == baudrate]
+    return LinkProfile(baudrate,
+                       max(p.timeout for p in profiles),
+                       max(p.interByteTimeout for p in profiles),
+                       max(p.turnaround for p in profiles),
+                       max(p.calibrated for p in profiles))
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+#
+# Serial link calibration.
+#
+# A fixed one second timeout means every lost reply costs a full second no
+# matter how fast the bus and the controller are.  calibrate() finds the
+# fastest baud rate the controller answers on, measures how long the controller
+# takes between the end of a request and the start of its reply (the
+# turnaround) and derives the timeouts from that and the time one character
+# takes on the wire:
+#
+#   - the inter-byte timeout is the Modbus 3.5 character silence that ends a
+#     frame (fixed at 1.75 ms above 19200 baud), so a reply that stalls half
+#     way fails right away instead of waiting out the response timeout
+#   - the response timeout covers the slowest turnaround seen with a margin
+#     plus the time the longest possible reply takes to arrive
+#
+# Both get LATENCY_SLACK added for the USB adapter, which holds bytes back for
+# its latency timer before passing them on.
+#
+# Profiles are kept per port and device by linkprofile and getRs485 uses them
+# for any setting it is not given.  Only reads are calibrated, writes go to
+# EEPROM and SerialTransport gives their replies at least its writeTimeout.
+import argparse
+import time
+
+import commander
+import linkprofile
+import transport
+
+# Fastest first, the first one that answers cleanly wins
+BAUD_RATES = (115200, 57600, 38400, 19200, 9600)
+
+# Rated PV voltage, every controller has it and it never changes
+PROBE_ADDRESS = 0x3000
+
+# Start, 8 data and 1 stop bit
+BITS_PER_CHARACTER = 10
+
+# Longest RTU frame there is
+MAX_FRAME = 256
+
+# FTDI style adapters hold received bytes for up to 16 ms by default
+LATENCY_SLACK = 0.016
+
+# Multiplies the slowest turnaround seen
+MARGIN = 2.0
+
+# The response timeout never goes below this, 20 probes of one register do
+# not show every hiccup of a busy controller
+MIN_TIMEOUT = 0.1
+
+
+def characterTime(baudrate):
+    """
+    Seconds one character takes on the wire.
+    """
+    return float(BITS_PER_CHARACTER) / baudrate
+
+
+def interFrameGap(baudrate):
+    """
+    The Modbus RTU 3.5 character silence between frames in seconds.
+    """
+    if baudrate > 19200:
+        return 0.00175
+    return 3.5 * characterTime(baudrate)
+
+
+def deriveProfile(baudrate, turnaround):
+    """
+    Return the LinkProfile for a baud rate and the slowest turnaround seen.
+    """
+    timeout = turnaround * MARGIN + MAX_FRAME * characterTime(baudrate)
+    return linkprofile.LinkProfile(baudrate,
+                                   max(timeout + LATENCY_SLACK, MIN_TIMEOUT),
+                                   interFrameGap(baudrate) + LATENCY_SLACK,
+                                   turnaround,
+                                   time.time())
+
+
+def measureTurnaround(link, deviceId, baudrate, samples=20, debug=False):
+    """
+    Read PROBE_ADDRESS samples times and return the slowest turnaround in
+    seconds, the round trip less the time the frames take on the wire.
+    Raises RuntimeError if any read fails.
+
+    @type link: transport.RtuTransport
+    """
+    slowest = 0.0
+    for _ in xrange(samples):
+        commander.transact(link, deviceId, PROBE_ADDRESS, 1, debug)
+        wire = (len(link.lastRequest) + len(link.lastReply)) * \
+            characterTime(baudrate)
+        slowest = max(slowest, link.received - link.sent - wire)
+    return slowest
+
+
+def calibrate(port, deviceId, rates=BAUD_RATES, samples=20, debug=False):
+    """
+    Probe the baud rates in order and return the LinkProfile of the first one
+    the controller answers every probe on.  Raises RuntimeError if none work.
+    """
+    for baudrate in rates:
+        ser = commander.getRs485(port, baudrate=baudrate, timeout=0.5)
+        link = transport.SerialTransport(ser)
+        try:
+            ser.reset_input_buffer()
+            turnaround = measureTurnaround(link, deviceId, baudrate, samples,
+                                           debug)
+        except RuntimeError as e:
+            if debug:
+                print "%d baud: %s" % (baudrate, e)
+            continue
+        finally:
+            link.close()
+        return deriveProfile(baudrate, turnaround)
+    raise RuntimeError("Device %d did not answer on %s at any baud rate" %
+                       (deviceId, port))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Calibrate a serial link")
+    parser.add_argument("--port", default=None)
+    parser.add_argument("--device", type=int, default=1)
+    parser.add_argument("--samples", type=int, default=20)
+    parser.add_argument("--path", default=linkprofile.PROFILE_PATH)
+    parser.add_argument("--debug", action="store_true")
+    args = parser.parse_args()
+
+    port = args.port or commander.defaultPort()
+    profile = calibrate(port, args.device, samples=args.samples,
+                        debug=args.debug)
+    linkprofile.saveProfile(port, args.device, profile, args.path)
+    print "%s device %d: %d baud, turnaround %.1f ms, timeout %.1f ms, " \
+          "inter-byte timeout %.1f ms" % (port, args.device, profile.baudrate,
+                                          profile.turnaround * 1000,
+                                          profile.timeout * 1000,
+                                          profile.interByteTimeout * 1000)
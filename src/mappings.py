@@ -42,6 +42,7 @@ REGISTERS = {
     2: Register("Manual control the load", "When the load is manual mode, 1-manual on, 0 -manual off", MANUALMODE, 1, 1),
     5: Register("Enable load test mode", "1 Enable, 0 Disable(normal)", ENABLETEST, 1, 1),
     6: Register("Force the load on/off", "1 Turn on, 0 Turn off (used for temporary test of the load)", OFFON, 1, 1),
+    # Discrete inputs
     0x2000: Register("Over temperature inside the device", "Over temperature inside device", OVERTEMP, 1, 1),
     0x200C: Register("Night", "1-Night, 0-Day", DAYNIGHT, 1, 1),
     # Input registers
@@ -137,3 +138,10 @@ REGISTERS = {
     0x906E: Register("Charging percentage", "Depth of charge, 20%-100%.", P, 1, 1),
     0x9070: Register("Management modes of battery charging and discharging", "Management modes of battery charge and discharge, voltage compensation : 0 and SOC : 1.", MANAGEMENTMODES, 1, 1)}
 
+
+
+# Coils and discrete inputs are read a whole range at a time since every bit of
+# the range comes back in the same few bytes.  These are (first address, count)
+# tuples that cover every bit register above.
+BIT_RANGES = [(0x0002, 5),
+              (0x2000, 13)]
@@ -0,0 +1,263 @@
+# Module for publishing controller data to an MQTT broker.
+#
+# Publisher is fed whole sweeps from the polling loop.  It either sends the
+# whole sweep as one JSON payload or only the values that changed since they
+# were last sent, each on its own retained topic.  It keeps one connection open
+# for its whole life.  While the broker can not be reached messages go to a
+# bounded Spool on disk and are sent, oldest first, once it is back.
+#
+# paho-mqtt is only needed for PahoClient.  MemoryBroker and MemoryClient stand
+# in for a broker and a client in the same process for testing.
+import collections
+import json
+import os
+import re
+import threading
+import time
+
+import mappings
+
+try:
+    import paho.mqtt.client as paho
+except ImportError:
+    paho = None
+
+
+def slug(text):
+    """
+    Turn a register name or unit into something that is safe in a topic.
+    """
+    return re.sub(r"[^a-z0-9]+", "_", text.lower()).strip("_")
+
+
+def topicFor(prefix, deviceId, address, result, multiple=False):
+    """
+    Topic of one Result, e.g. "mppt/1/battery_soc" or, for registers that
+    decode into several Results, "mppt/1/battery_status/battery_voltage".
+
+    @param multiple: True if the Result is one of several from its register
+    """
+    register = mappings.REGISTERS.get(address)
+    name = slug(register.name) if register is not None else "%04x" % address
+    topic = "%s/%d/%s" % (prefix, deviceId, name)
+    if multiple:
+        topic += "/" + slug(result.unit)
+    return topic
+
+
+def _flatten(results):
+    """
+    Yield (address, Result, multiple) tuples from a dictionary of address to
+    what the register unit function returned (a Result or a list of them).
+    """
+    for addr, result in sorted(results.iteritems()):
+        if isinstance(result, list):
+            for item in result:
+                yield addr, item, True
+        else:
+            yield addr, result, False
+
+
+class Spool(object):
+    def __init__(self, path, maxMessages=10000):
+        """
+        Bounded first in, first out queue of (topic, payload, retain)
+        messages kept in a file, one JSON list per line.  When it is full the
+        oldest message is dropped.
+
+        New messages are only ever appended.  Dropped messages stay in the
+        file until it holds twice maxMessages lines and it is then rewritten
+        once, so during a long broker outage every message is written about
+        twice instead of the file being rewritten for every message.  They
+        are always the oldest lines, so loading the file skips them again.
+        """
+        self.path = path
+        self.maxMessages = maxMessages
+        self.dropped = 0
+        self.__messages = collections.deque()
+        self.__lines = 0
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    if line.strip():
+                        self.__messages.append(tuple(json.loads(line)))
+                        self.__lines += 1
+            self.__trim()
+
+    def __len__(self):
+        return len(self.__messages)
+
+    def put(self, topic, payload, retain=False):
+        self.__messages.append((topic, payload, retain))
+        self.__trim()
+        if self.__lines >= 2 * self.maxMessages:
+            self.__rewrite()
+        else:
+            with open(self.path, "a") as f:
+                f.write(json.dumps([topic, payload, retain]) + "\n")
+            self.__lines += 1
+
+    def drain(self, publish):
+        """
+        Send spooled messages with publish(topic, payload, retain) until it
+        returns False or the spool is empty.  Returns the number sent.
+        """
+        sent = 0
+        while self.__messages:
+            if not publish(*self.__messages[0]):
+                break
+            self.__messages.popleft()
+            sent += 1
+        if sent:
+            self.__rewrite()
+        return sent
+
+    def __trim(self):
+        while len(self.__messages) > self.maxMessages:
+            self.__messages.popleft()
+            self.dropped += 1
+
+    def __rewrite(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            for message in self.__messages:
+                f.write(json.dumps(list(message)) + "\n")
+        os.rename(tmp, self.path)
+        self.__lines = len(self.__messages)
+
+
+class Publisher(object):
+    def __init__(self, client, prefix="mppt", changesOnly=False, spool=None,
+                 qos=1):
+        """
+        @param client: PahoClient, MemoryClient or anything else with a
+                       connected attribute and publish(topic, payload, qos,
+                       retain) that returns True once the message is handed
+                       to the broker
+        @param prefix: First level of every topic
+        @param changesOnly: Publish changed values on their own topics
+                            instead of whole snapshots on one topic
+        @type spool: Spool
+        @param spool: Where messages wait while the broker is away, None to
+                      drop them
+        """
+        self.client = client
+        self.prefix = prefix
+        self.changesOnly = changesOnly
+        self.spool = spool
+        self.qos = qos
+        self.__last = {}
+
+    def publish(self, deviceId, results, when=None):
+        """
+        Publish one sweep.
+
+        @param results: Dictionary of address to what the register unit
+                        function returned
+        @param when: Wall clock time of the sweep, now if not given
+        """
+        if when is None:
+            when = time.time()
+        if self.changesOnly:
+            for addr, result, multiple in _flatten(results):
+                topic = topicFor(self.prefix, deviceId, addr, result, multiple)
+                if self.__last.get(topic) == result.value:
+                    continue
+                self.__last[topic] = result.value
+                self.__send(topic, json.dumps({"time": when,
+                                               "unit": result.unit,
+                                               "value": result.value}),
+                            retain=True)
+        else:
+            values = {}
+            for addr, result, multiple in _flatten(results):
+                topic = topicFor("", deviceId, addr, result, multiple)
+                values[topic.split("/", 2)[2]] = result.value
+            self.__send("%s/%d/snapshot" % (self.prefix, deviceId),
+                        json.dumps({"time": when, "values": values},
+                                   sort_keys=True),
+                        retain=False)
+
+    def __send(self, topic, payload, retain):
+        if self.spool is not None and len(self.spool):
+            # Keep the order, the backlog goes out before anything new
+            self.spool.drain(self.__publish)
+            if len(self.spool):
+                self.spool.put(topic, payload, retain)
+                return
+        if not self.__publish(topic, payload, retain) and \
+                self.spool is not None:
+            self.spool.put(topic, payload, retain)
+
+    def __publish(self, topic, payload, retain=False):
+        if not self.client.connected:
+            return False
+        try:
+            return self.client.publish(topic, payload, self.qos, retain)
+        except (IOError, RuntimeError):
+            return False
+
+
+class PahoClient(object):
+    def __init__(self, host, port=1883, clientId="", keepalive=60):
+        """
+        Persistent connection to a real broker through paho-mqtt.  paho keeps
+        reconnecting in the background after the connection drops.
+        """
+        if paho is None:
+            raise RuntimeError("paho-mqtt is needed to talk to a broker")
+        self.connected = False
+        self.client = paho.Client(clientId)
+        self.client.on_connect = self.__onConnect
+        self.client.on_disconnect = self.__onDisconnect
+        self.client.connect_async(host, port, keepalive)
+        self.client.loop_start()
+
+    def __onConnect(self, client, userdata, flags, rc):
+        self.connected = rc == 0
+
+    def __onDisconnect(self, client, userdata, rc):
+        self.connected = False
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        info = self.client.publish(topic, payload, qos, retain)
+        return info.rc == paho.MQTT_ERR_SUCCESS
+
+    def close(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+
+class MemoryBroker(object):
+    def __init__(self):
+        """
+        Broker stand-in that keeps every message and the retained ones.
+        """
+        self.lock = threading.Lock()
+        self.messages = []
+        self.retained = {}
+
+    def publish(self, topic, payload, qos, retain):
+        with self.lock:
+            self.messages.append((topic, payload))
+            if retain:
+                self.retained[topic] = payload
+
+
+class MemoryClient(object):
+    def __init__(self, broker):
+        """
+        Client stand-in for a MemoryBroker.  Set connected to False to act as
+        if the broker went away.
+        """
+        self.broker = broker
+        self.connected = True
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        if not self.connected:
+            return False
+        self.broker.publish(topic, payload, qos, retain)
+        return True
+
+    def close(self):
+        self.connected = False
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+#
+# Poll several controllers on several serial ports at once.
+#
+# Each bus gets its own worker thread that sweeps the registers of every device
+# on that bus.  The buses run in parallel so a full sweep of the site takes as
+# long as the slowest bus rather than the sum of them.  All workers feed one
+# bounded queue of timestamped Samples.  When the consumer falls behind the
+# queue fills up and the workers block, so a slow writer slows the polling down
+# instead of growing memory without bound.
+import argparse
+import Queue
+import socket
+import threading
+import time
+from collections import namedtuple
+
+import commander
+import mappings
+import transport
+
+
+class Sample(namedtuple("Sample", ["time",
+                                   "port",
+                                   "deviceId",
+                                   "address",
+                                   "result",
+                                   "error"])):
+    """
+    @type time: float
+    @param time: Host time (seconds since the epoch) the reply was received
+    @type port: string
+    @param port: The name of the bus the sample came from
+    @type deviceId: int
+    @param deviceId: The ID of the device on that bus
+    @type address: int
+    @param address: The register address
+    @param result: What commander.communicate returned, None on error
+    @param error: The exception raised while reading, None on success
+    """
+    __slots__ = ()
+
+
+class BusWorker(threading.Thread):
+    def __init__(self, name, link, deviceIds, registers, output, interval=0,
+                 sweeps=None, engine=None):
+        """
+        Sweep every register of every device on one bus.
+
+        @param name: The name used for the port field of the Samples
+        @param link: The serial connection or transport.Transport to poll
+        @param deviceIds: The IDs of the devices on the bus
+        @param registers: Dictionary of address to mappings.Register
+        @type output: Queue.Queue
+        @param output: Where Samples are put
+        @param interval: Seconds between the start of one sweep and the next
+        @param sweeps: Number of sweeps to do, None for forever
+        @type engine: alarms.AlarmEngine
+        @param engine: Gets the raw value of every register as it is read
+        """
+        threading.Thread.__init__(self, name="BusWorker-%s" % name)
+        self.daemon = True
+        self.port = name
+        self.transport = transport.wrap(link)
+        self.deviceIds = list(deviceIds)
+        # Coils and discrete inputs are read a whole range at a time
+        self.bitRegisters = dict((addr, reg)
+                                 for addr, reg in registers.iteritems()
+                                 if commander.isBitAddress(addr))
+        self.registers = sorted((addr, reg)
+                                for addr, reg in registers.iteritems()
+                                if addr not in self.bitRegisters)
+        self.output = output
+        self.interval = interval
+        self.sweeps = sweeps
+        self.engine = engine
+        self.running = True
+
+    def sweep(self):
+        """
+        Read every register of every device once.
+        """
+        for deviceId in self.deviceIds:
+            try:
+                bits = commander.readBitValues(self.transport,
+                                               deviceId,
+                                               self.bitRegisters)
+                errors = {}
+            except Exception as e:
+                bits = {}
+                errors = dict.fromkeys(self.bitRegisters, e)
+            stamp = time.time()
+            for addr, reg in sorted(self.bitRegisters.iteritems()):
+                result = None
+                if addr in bits:
+                    result = reg.unit(addr, bits[addr], reg.times)
+                    if self.engine is not None:
+                        self.engine.observe(deviceId, addr, bits[addr], stamp,
+                                            self.port)
+                self.output.put(Sample(stamp,
+                                       self.port,
+                                       deviceId,
+                                       addr,
+                                       result,
+                                       errors.get(addr)))
+
+            for addr, reg in self.registers:
+                if not self.running:
+                    return
+                result = None
+                error = None
+                try:
+                    data = commander.transact(self.transport,
+                                              deviceId,
+                                              addr,
+                                              reg.numWords)
+                    stamp = time.time()
+                    raw = commander.combineBytes(data)
+                    result = reg.unit(addr, raw, reg.times)
+                    if self.engine is not None:
+                        self.engine.observe(deviceId, addr, raw, stamp,
+                                            self.port)
+                except Exception as e:
+                    stamp = time.time()
+                    error = e
+                # Blocks while the queue is full, that is the back-pressure
+                self.output.put(Sample(stamp,
+                                       self.port,
+                                       deviceId,
+                                       addr,
+                                       result,
+                                       error))
+
+    def run(self):
+        count = 0
+        while self.running and (self.sweeps is None or count < self.sweeps):
+            start = time.time()
+            self.sweep()
+            count += 1
+            remaining = self.interval - (time.time() - start)
+            if remaining > 0:
+                time.sleep(remaining)
+
+
+def busName(link, index=0):
+    """
+    Name for a bus that was not given one: the serial port name for a port
+    name, a serial connection or a transport.SerialTransport, "host:port"
+    for the TCP transports and "bus<index>" for anything else.
+    """
+    if isinstance(link, basestring):
+        return link
+    ser = getattr(link, "ser", link)
+    if getattr(ser, "port", None):
+        return ser.port
+    sock = getattr(link, "sock", None)
+    if sock is not None:
+        try:
+            return "%s:%d" % sock.getpeername()[:2]
+        except socket.error:
+            pass
+    return "bus%d" % index
+
+
+class MultiBusPoller(object):
+    def __init__(self, buses, registers=None, maxQueued=1000, interval=0,
+                 sweeps=None, engine=None):
+        """
+        @param buses: List of (port, deviceIds) or (name, port, deviceIds)
+                      tuples.  port is either a serial port name for
+                      commander.getRs485 or an already open serial
+                      connection or transport.Transport.  name is what the
+                      Samples and alarms call the bus, see busName for what
+                      it is when not given.
+        @param registers: Dictionary of address to mappings.Register, all of
+                          mappings.REGISTERS by default
+        @param maxQueued: How many Samples can wait for the consumer before
+                          the workers block
+        @param interval: Seconds between the start of one sweep and the next
+        @param sweeps: Number of sweeps each bus does, None for forever
+        @type engine: alarms.AlarmEngine
+        @param engine: Gets the raw value of every register as it is read,
+                       with the bus name as the port
+        """
+        if registers is None:
+            registers = mappings.REGISTERS
+        self.queue = Queue.Queue(maxQueued)
+        self.workers = []
+        for index, bus in enumerate(buses):
+            if len(bus) == 3:
+                name, port, deviceIds = bus
+            else:
+                port, deviceIds = bus
+                name = busName(port, index)
+            if isinstance(port, basestring):
+                port = commander.getRs485(port)
+            self.workers.append(BusWorker(name, port, deviceIds, registers,
+                                          self.queue, interval, sweeps,
+                                          engine))
+
+    def start(self):
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self):
+        """
+        Ask every worker to stop after the read it is doing and close the
+        ports.  Samples still in the queue are discarded to unblock workers.
+        """
+        for worker in self.workers:
+            worker.running = False
+        for worker in self.workers:
+            while worker.is_alive():
+                try:
+                    self.queue.get_nowait()
+                except Queue.Empty:
+                    pass
+                worker.join(0.01)
+            worker.transport.close()
+
+    def samples(self):
+        """
+        Generator of Samples from every bus in the order they were read.  It
+        ends once every worker has finished its sweeps.
+        """
+        while True:
+            try:
+                yield self.queue.get(timeout=0.1)
+            except Queue.Empty:
+                if not any(w.is_alive() for w in self.workers):
+                    break
+
+
+def parseBus(text):
+    """
+    Parse "port:id,id,..." into a (port, [ids]) tuple.  The IDs default to 1.
+    """
+    port, _, ids = text.rpartition(":")
+    if not port:
+        return ids, [0x01]
+    return port, [int(i, 0) for i in ids.split(",")]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Poll several buses at once")
+    parser.add_argument("buses", nargs="+", metavar="PORT[:ID,ID...]")
+    parser.add_argument("--interval", type=float, default=0)
+    parser.add_argument("--sweeps", type=int, default=1)
+    args = parser.parse_args()
+
+    poller = MultiBusPoller([parseBus(b) for b in args.buses],
+                            interval=args.interval,
+                            sweeps=args.sweeps)
+    poller.start()
+    try:
+        for sample in poller.samples():
+            print "%.3f %s %d %s: %s" % (sample.time,
+                                         sample.port,
+                                         sample.deviceId,
+                                         hex(sample.address),
+                                         sample.error or sample.result)
+    finally:
+        poller.stop()
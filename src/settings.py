@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+#
+# Snapshots of a controller's settings (the holding registers from 0x9000 on)
+# for auditing a fleet.
+#
+# readSettings() reads every setting in mappings.REGISTERS with one block read
+# per run of consecutive addresses instead of one transaction per register.
+# The real time clock is left out, it changes every second and is looked after
+# by timing.RtcMonitor.
+#
+# A Profile is the raw values with a hash of them.  ProfileStore keeps the
+# latest Profile of every controller on disk, with a revision number that goes
+# up whenever the hash changes.  The controller has nothing that tells whether
+# its settings changed short of reading them all, so check() always does the
+# full block read.  The hash then decides whether anything changed and whether
+# the store needs a new revision.
+#
+# diff() returns the registers that differ from a desired Profile and
+# applyProfile() writes them, consecutive registers together in one
+# transaction each.
+import argparse
+import hashlib
+import json
+import os
+import re
+import time
+from collections import namedtuple
+
+import commander
+import mappings
+import timing
+import transport
+
+FORMAT_VERSION = 1
+
+STORE_PATH = os.path.expanduser("~/.mpptCommander/settings")
+
+# Most registers a read (function 0x03) may ask for
+MAX_WORDS = 125
+
+RTC = frozenset(xrange(timing.RTC_ADDRESS,
+                       timing.RTC_ADDRESS + timing.RTC_WORDS))
+
+SETTINGS = sorted(addr for addr in mappings.REGISTERS
+                  if addr >= 0x9000 and addr not in RTC)
+
+
+def planBlocks(addresses, maxGap=0, maxWords=MAX_WORDS):
+    """
+    Group addresses into as few (start, count) block reads as possible.
+
+    @param maxGap: Undefined addresses a block may span.  The controller
+                   answers reads of undefined addresses with an exception, so
+                   the default only groups addresses that are consecutive.
+    @param maxWords: Most registers one block may hold
+    """
+    blocks = []
+    for addr in sorted(addresses):
+        if blocks:
+            start, count = blocks[-1]
+            if addr - (start + count) <= maxGap and \
+                    addr - start + 1 <= maxWords:
+                blocks[-1] = (start, addr - start + 1)
+                continue
+        blocks.append((addr, 1))
+    return blocks
+
+
+def readBlocks(link, deviceId, blocks, debug=False):
+    """
+    Read the blocks and return a dictionary of address to raw 16 bit value.
+    """
+    values = {}
+    for start, count in blocks:
+        data = commander.transact(link, deviceId, start, count, debug)
+        for i in xrange(count):
+            values[start + i] = data[2 * i] << 8 | data[2 * i + 1]
+    return values
+
+
+def hashValues(values):
+    """
+    Hex SHA-1 of a dictionary of address to raw value.
+    """
+    text = ",".join("%04x=%04x" % item for item in sorted(values.iteritems()))
+    return hashlib.sha1(text).hexdigest()
+
+
+class Profile(namedtuple("Profile", ["values", "hash", "revision", "taken"])):
+    """
+    @type values: dict
+    @param values: Address to raw 16 bit value
+    @type hash: str
+    @param hash: hashValues(values)
+    @type revision: int
+    @param revision: Goes up by one every time the stored values change
+    @type taken: float
+    @param taken: Wall clock time the values were read
+    """
+    __slots__ = ()
+
+    @classmethod
+    def fromValues(cls, values, revision=0, taken=None):
+        return cls(dict(values), hashValues(values), revision,
+                   time.time() if taken is None else taken)
+
+    def toJson(self):
+        return {"version": FORMAT_VERSION,
+                "hash": self.hash,
+                "revision": self.revision,
+                "taken": self.taken,
+                "values": dict(("0x%04x" % addr, value)
+                               for addr, value in self.values.iteritems())}
+
+    @classmethod
+    def fromJson(cls, data):
+        if data.get("version") != FORMAT_VERSION:
+            raise RuntimeError("Unknown settings profile version %s" %
+                               data.get("version"))
+        values = dict((int(addr, 16), value)
+                      for addr, value in data["values"].iteritems())
+        if hashValues(values) != data["hash"]:
+            raise RuntimeError("Settings profile does not match its hash")
+        return cls(values, data["hash"], data["revision"], data["taken"])
+
+
+def profileName(port, deviceId):
+    """
+    File name safe name of a controller, e.g. "dev_ttyXRUSB0-1".
+    """
+    return "%s-%d" % (re.sub(r"[^A-Za-z0-9]+", "_", port).strip("_"),
+                      deviceId)
+
+
+class ProfileStore(object):
+    def __init__(self, directory=STORE_PATH):
+        """
+        Keeps one Profile per controller as a JSON file in directory.
+        """
+        self.directory = directory
+
+    def path(self, name):
+        return os.path.join(self.directory, name + ".json")
+
+    def load(self, name):
+        """
+        Return the stored Profile, None if there is none.
+        """
+        path = self.path(name)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return Profile.fromJson(json.load(f))
+
+    def save(self, name, profile):
+        """
+        Store a Profile.  Its revision is set to one more than the stored one
+        if the values changed and kept if they did not.  Returns the Profile
+        that was stored.
+        """
+        stored = self.load(name)
+        if stored is None:
+            profile = profile._replace(revision=1)
+        elif stored.hash != profile.hash:
+            profile = profile._replace(revision=stored.revision + 1)
+        else:
+            profile = profile._replace(revision=stored.revision)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = self.path(name)
+        with open(path + ".tmp", "w") as f:
+            json.dump(profile.toJson(), f, indent=2, sort_keys=True)
+        os.rename(path + ".tmp", path)
+        return profile
+
+
+def readSettings(link, deviceId, addresses=SETTINGS, debug=False):
+    """
+    Read every setting and return a Profile of them.
+    """
+    link = transport.wrap(link)
+    return Profile.fromValues(readBlocks(link, deviceId,
+                                         planBlocks(addresses), debug))
+
+
+def check(link, deviceId, store, name, debug=False):
+    """
+    Read every setting and return (Profile, changed).  changed is True if
+    the hash differs from the stored Profile, which is then replaced.
+    """
+    stored = store.load(name)
+    profile = readSettings(link, deviceId, debug=debug)
+    if stored is not None and stored.hash == profile.hash:
+        return stored, False
+    return store.save(name, profile), True
+
+
+def diff(current, desired):
+    """
+    Return a dictionary of address to desired raw value for every setting in
+    desired (a Profile or a dictionary) that current has a different value
+    for.  The real time clock is never part of a diff.
+    """
+    if isinstance(desired, Profile):
+        desired = desired.values
+    if isinstance(current, Profile):
+        current = current.values
+    return dict((addr, value) for addr, value in desired.iteritems()
+                if addr not in RTC and current.get(addr) != value)
+
+
+def coalesce(changes):
+    """
+    Return [(address, [values])] writes with consecutive addresses merged.
+    """
+    writes = []
+    for addr, value in sorted(changes.iteritems()):
+        if writes and writes[-1][0] + len(writes[-1][1]) == addr:
+            writes[-1][1].append(value)
+        else:
+            writes.append((addr, [value]))
+    return writes
+
+
+def applyProfile(link, deviceId, desired, store=None, name=None, debug=False):
+    """
+    Write the settings that differ from desired and return the writes done.
+    The settings are read first; if a store and name are given the Profile
+    read back afterwards is stored.
+    """
+    link = transport.wrap(link)
+    current = readSettings(link, deviceId, debug=debug)
+    writes = coalesce(diff(current, desired))
+    for addr, values in writes:
+        commander.writeRegisters(link, deviceId, addr, values, debug)
+    if store is not None and name is not None:
+        store.save(name, readSettings(link, deviceId, debug=debug))
+    return writes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Audit controller settings")
+    parser.add_argument("command", choices=("snapshot", "check", "apply"))
+    parser.add_argument("--port", default=None)
+    parser.add_argument("--device", type=int, action="append",
+                        help="Device id, can be given more than once")
+    parser.add_argument("--store", default=STORE_PATH)
+    parser.add_argument("--desired", help="Profile file for apply")
+    parser.add_argument("--debug", action="store_true")
+    args = parser.parse_args()
+
+    port = args.port or commander.defaultPort()
+    store = ProfileStore(args.store)
+    desired = None
+    if args.command == "apply":
+        if not args.desired:
+            parser.error("apply needs --desired")
+        with open(args.desired) as f:
+            desired = Profile.fromJson(json.load(f))
+    link = transport.SerialTransport(commander.getRs485(port))
+    try:
+        for deviceId in args.device or [1]:
+            name = profileName(port, deviceId)
+            if args.command == "snapshot":
+                profile = store.save(name, readSettings(link, deviceId,
+                                                        debug=args.debug))
+                print "%s: revision %d %s" % (name, profile.revision,
+                                              profile.hash)
+            elif args.command == "check":
+                profile, changed = check(link, deviceId, store, name,
+                                         args.debug)
+                print "%s: revision %d %s%s" % (name, profile.revision,
+                                                profile.hash,
+                                                " changed" if changed else "")
+            else:
+                writes = applyProfile(link, deviceId, desired, store, name,
+                               args.debug)
+                for addr, values in writes:
+                    print "%s: wrote %d registers at %s" % (name, len(values),
+                                                           hex(addr))
+    finally:
+        link.close()
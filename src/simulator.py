@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+#
+# Simulated Commander for testing without the hardware.
+#
+# SimulatedController answers Modbus requests from an in-memory register map.
+# SimulatedTransport plugs one or more of them straight into anything that
+# takes a transport.Transport, and RtuServer serves them as RTU over TCP on a
+# local socket so the network transports can be exercised end to end.
+import argparse
+import SocketServer
+import struct
+import threading
+import time
+
+import clock
+import mappings
+import transport
+
+# Modbus exception codes
+ILLEGAL_FUNCTION = 0x01
+ILLEGAL_ADDRESS = 0x02
+ILLEGAL_VALUE = 0x03
+
+
+class SimulatedController(object):
+    def __init__(self, words=None, bits=None):
+        """
+        A controller whose registers live in dictionaries.  Anything not given
+        starts out as zero for every address in mappings.REGISTERS and
+        mappings.BIT_RANGES.
+
+        @type words: dict
+        @param words: 16 bit register values keyed by address
+        @type bits: dict
+        @param bits: Coil and discrete input values keyed by address
+        """
+        self.words = {}
+        self.bits = {}
+        for first, count in mappings.BIT_RANGES:
+            for addr in xrange(first, first + count):
+                self.bits[addr] = 0
+        for addr, reg in mappings.REGISTERS.iteritems():
+            if addr >= 0x3000:
+                for i in xrange(reg.numWords):
+                    self.words[addr + i] = 0
+        self.words.update(words or {})
+        self.bits.update(bits or {})
+        self.lock = threading.Lock()
+
+    def setValue(self, address, value, numWords=1):
+        """
+        Store value over numWords registers, low word first like the controller
+        """
+        with self.lock:
+            for i in xrange(numWords):
+                self.words[address + i] = (value >> (16 * i)) & 0xFFFF
+
+    def handle(self, function, payload):
+        """
+        Return the reply data for a request the same way Transport.transact
+        does, raising transport.ModbusError for exception replies.
+        """
+        payload = bytearray(payload)
+        if len(payload) < 4:
+            raise transport.ModbusError(function, ILLEGAL_VALUE)
+        address, count = struct.unpack(">HH", bytes(payload[:4]))
+        with self.lock:
+            if function in (0x01, 0x02):
+                return self.__readBits(function, address, count)
+            elif function in (0x03, 0x04):
+                return self.__readWords(function, address, count)
+            elif function == 0x05:
+                self.__check(function, self.bits, [address])
+                self.bits[address] = 1 if count == 0xFF00 else 0
+                return payload[:4]
+            elif function == 0x06:
+                self.__check(function, self.words, [address])
+                self.words[address] = count
+                return payload[:4]
+            elif function == 0x10:
+                addresses = range(address, address + count)
+                self.__check(function, self.words, addresses)
+                for i, addr in enumerate(addresses):
+                    self.words[addr] = (payload[5 + 2 * i] << 8 |
+                                        payload[6 + 2 * i])
+                return payload[:4]
+        raise transport.ModbusError(function, ILLEGAL_FUNCTION)
+
+    def __check(self, function, table, addresses):
+        for addr in addresses:
+            if addr not in table:
+                raise transport.ModbusError(function, ILLEGAL_ADDRESS)
+
+    def __readBits(self, function, address, count):
+        addresses = range(address, address + count)
+        self.__check(function, self.bits, addresses)
+        packed = bytearray((count + 7) // 8)
+        for i, addr in enumerate(addresses):
+            if self.bits[addr]:
+                packed[i // 8] |= 1 << (i % 8)
+        return bytearray([len(packed)]) + packed
+
+    def __readWords(self, function, address, count):
+        addresses = range(address, address + count)
+        self.__check(function, self.words, addresses)
+        reply = bytearray([2 * count])
+        for addr in addresses:
+            reply.extend(struct.pack(">H", self.words[addr]))
+        return reply
+
+
+class SimulatedTransport(transport.Transport):
+    def __init__(self, controllers, latency=0):
+        """
+        @type controllers: dict
+        @param controllers: SimulatedController instances keyed by device id
+        @param latency: Seconds each transaction takes, to mimic a slow bus
+        """
+        self.controllers = controllers
+        self.latency = latency
+
+    def _transact(self, deviceId, function, payload, debug):
+        self.sent = clock.monotonic()
+        if self.latency:
+            time.sleep(self.latency)
+        controller = self.controllers.get(deviceId)
+        if controller is None:
+            raise transport.FrameError("Timed out after 0 of 3 bytes")
+        reply = controller.handle(function, payload)
+        self.received = clock.monotonic()
+        return reply
+
+
+def requestLength(function, head):
+    """
+    Return the number of bytes left in an RTU request after the first seven
+    bytes have been read, including the CRC.
+    """
+    if function in (0x0F, 0x10):
+        # The seventh byte is the byte count of the values that follow
+        return head + 2
+    # Every other request is a fixed eight bytes
+    return 1
+
+
+class _RtuHandler(SocketServer.BaseRequestHandler):
+    def handle(self):
+        simulated = self.server.transport
+        sock = self.request
+        buf = sock.makefile("rb")
+        while True:
+            rec = bytearray(buf.read(7))
+            if len(rec) < 7:
+                break
+            rec.extend(buf.read(requestLength(rec[1], rec[6])))
+            if transport.frameCRC(rec[:-2]) != rec[-2:]:
+                # A real device stays quiet on a bad frame
+                continue
+            try:
+                data = simulated.transact(rec[0], rec[1], rec[2:-2])
+                reply = bytearray([rec[0], rec[1]]) + data
+            except transport.ModbusError as e:
+                reply = bytearray([rec[0], rec[1] | 0x80, e.code])
+            except transport.FrameError:
+                continue
+            reply.extend(transport.frameCRC(reply))
+            sock.sendall(bytes(reply))
+
+
+class RtuServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """
+    Serve a SimulatedTransport as RTU over TCP, the same thing a serial to
+    Ethernet converter in transparent mode would look like.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, simulated):
+        self.transport = simulated
+        SocketServer.TCPServer.__init__(self, address, _RtuHandler)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulated Commander")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8899)
+    parser.add_argument("--device", type=int, default=1)
+    args = parser.parse_args()
+
+    server = RtuServer((args.host, args.port),
+                       SimulatedTransport({args.device: SimulatedController()}))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
@@ -0,0 +1,263 @@
+# Module for time stamping readings and keeping the controller clock honest.
+#
+# A sweep over every register takes long enough that the first and last value
+# of one "reading" can be seconds apart.  The functions here keep the
+# clock.monotonic() send and receive time of every transaction next to its
+# result, and a Snapshot records the window a set of readings was taken in.
+#
+# The controller also has its own real time clock (0x9013-0x9015) that it uses
+# for the "00:00 clear every day" energy counters.  RtcMonitor compares it to
+# the host clock, estimates how fast it drifts and can set it right again.
+import datetime
+import time
+from collections import namedtuple
+
+import clock
+import commander
+import transport
+
+# First register of the real time clock block, see mappings.REGISTERS
+RTC_ADDRESS = 0x9013
+RTC_WORDS = 3
+
+
+class TimedResult(namedtuple("TimedResult", ["sent", "received", "result"])):
+    """
+    @type sent: float
+    @param sent: clock.monotonic() time the request started going out
+    @type received: float
+    @param received: clock.monotonic() time the reply was complete
+    @param result: What the register unit function returned
+    """
+    __slots__ = ()
+
+    @property
+    def midpoint(self):
+        """
+        Best guess of when the controller sampled the value.
+        """
+        return (self.sent + self.received) / 2.0
+
+
+class Snapshot(namedtuple("Snapshot", ["start", "end", "wallStart", "results"])):
+    """
+    @type start: float
+    @param start: clock.monotonic() time the first request started
+    @type end: float
+    @param end: clock.monotonic() time the last reply was complete
+    @type wallStart: float
+    @param wallStart: Host wall clock time matching start
+    @type results: dict
+    @param results: TimedResults keyed by register address
+    """
+    __slots__ = ()
+
+    @property
+    def window(self):
+        """
+        How long in seconds it took to take the snapshot.
+        """
+        return self.end - self.start
+
+
+def readTimed(link, deviceId, address, register, debug=False):
+    """
+    Same as commander.communicate but return a TimedResult.
+
+    @param link: The serial connection or transport.Transport to use.  Wrap
+                 a serial port once with transport.wrap when calling this
+                 often, it saves building a new transport every time.
+    """
+    link = transport.wrap(link)
+    result = commander.communicate(link, deviceId, address, register, debug)
+    return TimedResult(link.sent, link.received, result)
+
+
+def takeSnapshot(link, deviceId, registers, debug=False):
+    """
+    Read every register in the registers dictionary and return a Snapshot.
+    """
+    link = transport.wrap(link)
+    wallStart = time.time()
+    start = clock.monotonic()
+    results = {}
+    for addr, reg in sorted(registers.iteritems()):
+        results[addr] = readTimed(link, deviceId, addr, reg, debug)
+    return Snapshot(start, clock.monotonic(), wallStart, results)
+
+
+class InvalidRtcError(RuntimeError):
+    """
+    The controller clock holds something that is not a date, usually because
+    it was never set.
+    """
+    pass
+
+
+def decodeRtc(data):
+    """
+    Turn the six bytes of the 0x9013-0x9015 block into a datetime.  The
+    controller only keeps two digits of the year.  Raises InvalidRtcError if
+    they are not a valid date and time.
+    """
+    words = [data[i] << 8 | data[i + 1] for i in xrange(0, 2 * RTC_WORDS, 2)]
+    minute, second = (words[0] & 0xFF00) >> 8, words[0] & 0x00FF
+    day, hour = (words[1] & 0xFF00) >> 8, words[1] & 0x00FF
+    year, month = (words[2] & 0xFF00) >> 8, words[2] & 0x00FF
+    try:
+        return datetime.datetime(2000 + year, month, day, hour, minute, second)
+    except ValueError as e:
+        raise InvalidRtcError("Invalid controller clock %s: %s" %
+                              (" ".join("%04x" % w for w in words), e))
+
+
+def encodeRtc(when):
+    """
+    The opposite of decodeRtc, returns the three register values.
+    """
+    return [when.minute << 8 | when.second,
+            when.day << 8 | when.hour,
+            (when.year - 2000) << 8 | when.month]
+
+
+def readRtc(link, deviceId, debug=False):
+    """
+    Read the whole real time clock in one transaction.
+
+    Returns a (datetime, TimedResult) tuple, the TimedResult has the datetime
+    as its result.
+    """
+    link = transport.wrap(link)
+    data = commander.transact(link, deviceId, RTC_ADDRESS, RTC_WORDS, debug)
+    when = decodeRtc(data)
+    return when, TimedResult(link.sent, link.received, when)
+
+
+def writeRtc(link, deviceId, when, debug=False):
+    """
+    Set the real time clock.  The data sheet wants all of it written at once.
+    """
+    commander.writeRegisters(link, deviceId, RTC_ADDRESS, encodeRtc(when),
+                             debug)
+
+
+def _toSeconds(when):
+    """
+    Seconds since the epoch of a naive datetime taken as local time.
+    """
+    return time.mktime(when.timetuple())
+
+
+class DriftEstimator(object):
+    def __init__(self):
+        """
+        Least squares fit of offset (controller time - host time) against
+        host time.  Only running sums are kept so adding a sample is O(1).
+        """
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.__sx = 0.0
+        self.__sy = 0.0
+        self.__sxx = 0.0
+        self.__sxy = 0.0
+        self.__origin = None
+        self.lastOffset = None
+
+    def add(self, hostTime, deviceTime):
+        """
+        @param hostTime: Host wall clock time, seconds since the epoch
+        @param deviceTime: Controller time at the same moment, same units
+        """
+        if self.__origin is None:
+            # Keep the numbers small so the sums stay precise
+            self.__origin = hostTime
+        x = hostTime - self.__origin
+        y = deviceTime - hostTime
+        self.count += 1
+        self.__sx += x
+        self.__sy += y
+        self.__sxx += x * x
+        self.__sxy += x * y
+        self.lastOffset = y
+
+    @property
+    def offset(self):
+        """
+        Seconds the controller is ahead of the host right now, smoothed over
+        all samples.  None until there is a sample.
+        """
+        if not self.count:
+            return None
+        slope = self.rate or 0.0
+        meanX = self.__sx / self.count
+        meanY = self.__sy / self.count
+        now = time.time() - self.__origin
+        return meanY + slope * (now - meanX)
+
+    @property
+    def rate(self):
+        """
+        Drift in seconds per second (multiply by 1e6 for ppm), None until
+        there are two samples spread out in time.
+        """
+        denominator = self.count * self.__sxx - self.__sx * self.__sx
+        if self.count < 2 or denominator <= 0:
+            return None
+        return (self.count * self.__sxy - self.__sx * self.__sy) / denominator
+
+
+class RtcMonitor(object):
+    def __init__(self, link, deviceId, maxOffset=None):
+        """
+        Sample the controller clock against the host clock.
+
+        @param link: The serial connection or transport.Transport to use
+        @param deviceId: The ID number of the device on the bus
+        @param maxOffset: Set the controller clock once it is off by more than
+                          this many seconds.  None to never touch it.
+        """
+        self.link = transport.wrap(link)
+        self.deviceId = deviceId
+        self.maxOffset = maxOffset
+        self.estimator = DriftEstimator()
+        self.corrections = 0
+
+    def check(self):
+        """
+        Take one sample and correct the clock if needed.  Returns the
+        measured offset in seconds.
+
+        A clock that does not hold a valid date is infinitely far off: it is
+        corrected if maxOffset is set, otherwise InvalidRtcError is raised.
+        """
+        try:
+            when, timed = readRtc(self.link, self.deviceId)
+        except InvalidRtcError:
+            if self.maxOffset is None:
+                raise
+            self.correct()
+            return float("inf")
+        hostTime = clock.toWall(timed.midpoint)
+        # The clock only has whole seconds, on average it is half a second
+        # further along than it says.
+        self.estimator.add(hostTime, _toSeconds(when) + 0.5)
+        offset = self.estimator.lastOffset
+        if self.maxOffset is not None and abs(offset) > self.maxOffset:
+            self.correct()
+        return offset
+
+    def correct(self):
+        """
+        Set the controller clock to host local time.  The write is started on
+        a second boundary as near as we can manage since the clock has no
+        finer resolution.
+        """
+        now = time.time()
+        time.sleep(1.0 - (now - int(now)))
+        writeRtc(self.link,
+                 self.deviceId,
+                 datetime.datetime.fromtimestamp(round(time.time())))
+        self.corrections += 1
+        self.estimator.reset()
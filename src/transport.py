@@ -0,0 +1,474 @@
+# Module with the transports used to carry Modbus requests to a controller.
+#
+# A transport takes a request PDU (device id, function code and the bytes that
+# follow the function code) and returns the bytes that follow the function code
+# in the reply.  Framing, CRCs and headers are the transport's business so the
+# rest of the library does not care if the controller is on a local RS 485
+# adapter, behind a serial to Ethernet converter or behind a Modbus TCP gateway.
+import select
+import socket
+import struct
+from collections import namedtuple
+
+import clock
+import crc
+
+# Default TCP port for Modbus TCP.  Serial to Ethernet converters that pass RTU
+# frames through usually use something else, so there is no default for those.
+MODBUS_TCP_PORT = 502
+
+# Function codes that write to the controller
+WRITE_FUNCTIONS = frozenset([0x05, 0x06, 0x0F, 0x10])
+
+
+class ModbusError(RuntimeError):
+    """
+    The controller answered with a Modbus exception reply.
+    """
+    def __init__(self, function, code):
+        RuntimeError.__init__(self,
+                              "Modbus exception 0x%02x for function 0x%02x" %
+                              (code, function))
+        self.function = function
+        self.code = code
+
+
+class FrameError(RuntimeError):
+    """
+    The reply was short, timed out, had a bad CRC or did not match the request.
+    """
+    pass
+
+
+def frameCRC(frame):
+    """
+    Return the Modbus CRC of the given bytes as the two bytes that are sent on
+    the wire (low byte first).
+    """
+    crcv = crc.INITIAL_MODBUS
+    for ch in frame:
+        crcv = (crcv >> 8) ^ crc.table[(crcv ^ ch) & 0xFF]
+    return bytearray([crcv & 0x00FF, (crcv & 0xFF00) >> 8])
+
+
+def replyLength(function, head):
+    """
+    Return the number of bytes left in an RTU reply after the first three bytes
+    (device id, function code and one more) have been read.  This includes the
+    two CRC bytes.
+    """
+    if function & 0x80:
+        # Exception replies carry a one byte exception code
+        return 2
+    if function in (0x01, 0x02, 0x03, 0x04):
+        # Third byte is the byte count of the data that follows
+        return head + 2
+    if function in (0x05, 0x06, 0x0F, 0x10):
+        # Echo of the address and value/quantity
+        return 3 + 2
+    raise MismatchError("Unsupported function code 0x%02x" % function)
+
+
+def checkReply(function, payload, data):
+    """
+    Make sure the reply data (what follows the function code) answers the
+    request and not some other one.  A late reply to an earlier request has a
+    valid device id, function code and CRC, but usually not the same register
+    count or address.
+    """
+    if len(payload) < 4:
+        return
+    if function in (0x01, 0x02, 0x03, 0x04):
+        count = payload[2] << 8 | payload[3]
+        if function in (0x01, 0x02):
+            expected = (count + 7) // 8
+        else:
+            expected = 2 * count
+        if not data or data[0] != expected or len(data) != expected + 1:
+            raise MismatchError("Reply does not match request")
+    elif function in (0x05, 0x06, 0x0F, 0x10):
+        if data[:4] != bytearray(payload[:4]):
+            raise MismatchError("Reply does not match request")
+
+
+class TransactionEvent(namedtuple("TransactionEvent", ["deviceId",
+                                                       "function",
+                                                       "address",
+                                                       "count",
+                                                       "request",
+                                                       "reply",
+                                                       "latency",
+                                                       "retries",
+                                                       "crcOk",
+                                                       "error"])):
+    """
+    @type deviceId: int
+    @param deviceId: The ID of the device on the bus
+    @type function: int
+    @param function: The Modbus function code
+    @type address: int
+    @param address: The first address of the request
+    @type count: int
+    @param count: Registers or bits asked for, the value for single writes
+    @type request: bytearray
+    @param request: The request frame as sent, None if the transport has none
+    @type reply: bytearray
+    @param reply: The reply frame as far as it was received, None if nothing
+    @type latency: float
+    @param latency: Seconds from sending the request to the end of the reply
+                    (or the failure) of the last try
+    @type retries: int
+    @param retries: How many times the request was sent again
+    @type crcOk: bool
+    @param crcOk: None when no CRC was checked
+    @param error: The exception raised, None on success
+    """
+    __slots__ = ()
+
+    @property
+    def bytesOut(self):
+        return len(self.request) if self.request is not None else 0
+
+    @property
+    def bytesIn(self):
+        return len(self.reply) if self.reply is not None else 0
+
+
+class CrcError(FrameError):
+    """
+    The reply arrived complete but its CRC did not match.
+    """
+    pass
+
+
+class MismatchError(FrameError):
+    """
+    A reply arrived but answers some other request, e.g. a late reply to an
+    earlier one.
+    """
+    pass
+
+
+class Transport(object):
+    """
+    Base class for all transports.  Subclasses implement _transact.
+
+    After every transaction sent and received hold the clock.monotonic() time
+    the request started going out and the time the last byte of the reply
+    came in, lastRequest and lastReply hold the raw frames.
+
+    Hooks are callables that get a TransactionEvent after every transaction.
+    Attempt hooks get one after every try instead, so they also see the tries
+    that failed and were sent again.  With no hooks attached no event is
+    built, so leaving the hook points in costs next to nothing.
+    """
+    sent = None
+    received = None
+    lastRequest = None
+    lastReply = None
+    hooks = ()
+    attemptHooks = ()
+    # Times a transaction is tried again after a FrameError
+    retries = 0
+    # True when the frames carry a CRC that is checked
+    hasCRC = False
+
+    def addHook(self, hook):
+        self.hooks = list(self.hooks) + [hook]
+
+    def removeHook(self, hook):
+        self.hooks = [h for h in self.hooks if h is not hook]
+
+    def addAttemptHook(self, hook):
+        self.attemptHooks = list(self.attemptHooks) + [hook]
+
+    def removeAttemptHook(self, hook):
+        self.attemptHooks = [h for h in self.attemptHooks if h is not hook]
+
+    def transact(self, deviceId, function, payload, debug=False):
+        """
+        Send one request and return the reply data that follows the function
+        code.  Exception replies raise ModbusError.
+
+        @param deviceId: The ID number of the device on the bus
+        @param function: The Modbus function code
+        @param payload: The bytes that follow the function code
+        @param debug: Print the frames that are sent and received
+        """
+        attempt = 0
+        while True:
+            self.lastRequest = self.lastReply = None
+            self.sent = self.received = None
+            try:
+                reply = self._transact(deviceId, function, payload, debug)
+            except FrameError as e:
+                if attempt < self.retries:
+                    if self.attemptHooks:
+                        self._emit(deviceId, function, payload, attempt, e,
+                                   False)
+                    attempt += 1
+                    continue
+                if self.hooks or self.attemptHooks:
+                    self._emit(deviceId, function, payload, attempt, e)
+                raise
+            except Exception as e:
+                # ModbusError and anything from the port itself, such as an
+                # IOError when a USB adapter is unplugged
+                if self.hooks or self.attemptHooks:
+                    self._emit(deviceId, function, payload, attempt, e)
+                raise
+            if self.hooks or self.attemptHooks:
+                self._emit(deviceId, function, payload, attempt, None)
+            return reply
+
+    def _transact(self, deviceId, function, payload, debug):
+        raise NotImplementedError()
+
+    def _discard(self):
+        """
+        Throw away anything that arrived since the last reply, such as a
+        reply that came in after its request timed out.
+        """
+        pass
+
+    def _emit(self, deviceId, function, payload, retries, error, last=True):
+        """
+        Build the TransactionEvent of the try that just ended and hand it to
+        the attempt hooks, and to the hooks as well if it is the last try.
+        """
+        address = count = None
+        if len(payload) >= 4:
+            address = payload[0] << 8 | payload[1]
+            count = payload[2] << 8 | payload[3]
+        latency = 0.0
+        if self.sent is not None:
+            latency = (self.received or clock.monotonic()) - self.sent
+        crcOk = None
+        if self.hasCRC and self.lastReply is not None:
+            crcOk = not isinstance(error, CrcError)
+        event = TransactionEvent(deviceId,
+                                 function,
+                                 address,
+                                 count,
+                                 self.lastRequest,
+                                 self.lastReply,
+                                 latency,
+                                 retries,
+                                 crcOk,
+                                 error)
+        for hook in self.attemptHooks:
+            hook(event)
+        if last:
+            for hook in self.hooks:
+                hook(event)
+
+    def close(self):
+        pass
+
+    def _readExactly(self, count):
+        data = self._read(count)
+        if len(data) != count:
+            raise FrameError("Timed out after %d of %d bytes" %
+                             (len(data), count))
+        return data
+
+
+class RtuTransport(Transport):
+    """
+    Base class for transports that carry RTU frames, which is anything where the
+    frame has a trailing CRC and no header.  Subclasses provide _write and
+    _read.
+    """
+    hasCRC = True
+
+    def _write(self, frame):
+        raise NotImplementedError()
+
+    def _read(self, count):
+        """
+        Return up to count bytes, fewer only if the link timed out.
+        """
+        raise NotImplementedError()
+
+    def _transact(self, deviceId, function, payload, debug):
+        frame = bytearray([deviceId, function])
+        frame.extend(payload)
+        frame.extend(frameCRC(frame))
+
+        # If we have debug on, print out what we send and receive
+        if debug:
+            print "\tSending:", " ".join(hex(m) for m in frame)
+
+        self._discard()
+        self.lastRequest = frame
+        self.sent = clock.monotonic()
+        self._write(frame)
+
+        # Read the fixed part of the header first, that says how much is left
+        # so we never have to wait on the link to go quiet.
+        rec = self.lastReply = self._readExactly(3)
+        rec.extend(self._readExactly(replyLength(rec[1], rec[2])))
+        self.received = clock.monotonic()
+
+        if debug:
+            print "\tReceive:", " ".join('0x%01x' % m for m in rec)
+
+        if frameCRC(rec[:-2]) != rec[-2:]:
+            raise CrcError("Bad CRC in reply")
+        if rec[0] != deviceId or (rec[1] & 0x7F) != function:
+            raise MismatchError("Reply does not match request")
+        if rec[1] & 0x80:
+            raise ModbusError(function, rec[2])
+        checkReply(function, payload, rec[2:-2])
+        return rec[2:-2]
+
+
+class SerialTransport(RtuTransport):
+    # Writes go to EEPROM and linktune only calibrates reads, so a write
+    # waits at least this many seconds for its reply whatever the port's
+    # timeout is
+    writeTimeout = 1.0
+
+    def __init__(self, ser):
+        """
+        RTU over a serial port such as the one returned by commander.getRs485
+
+        @param ser: The serial connection used to communicate
+        """
+        self.ser = ser
+
+    def _transact(self, deviceId, function, payload, debug):
+        timeout = self.ser.timeout
+        if function not in WRITE_FUNCTIONS or timeout is None or \
+                timeout >= self.writeTimeout:
+            return RtuTransport._transact(self, deviceId, function, payload,
+                                          debug)
+        self.ser.timeout = self.writeTimeout
+        try:
+            return RtuTransport._transact(self, deviceId, function, payload,
+                                          debug)
+        finally:
+            self.ser.timeout = timeout
+
+    def _write(self, frame):
+        self.ser.write(frame)
+        self.ser.flush()
+
+    def _read(self, count):
+        return bytearray(self.ser.read(count))
+
+    def _discard(self):
+        self.ser.reset_input_buffer()
+
+    def close(self):
+        self.ser.close()
+
+
+class _SocketMixin(object):
+    """
+    Shared socket handling for the TCP transports.
+    """
+    def _connect(self, host, port, timeout):
+        self.sock = socket.create_connection((host, port), timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def _write(self, frame):
+        self.sock.sendall(bytes(frame))
+
+    def _discard(self):
+        while select.select([self.sock], [], [], 0)[0]:
+            if not self.sock.recv(4096):
+                break
+
+    def _read(self, count):
+        data = bytearray()
+        while len(data) < count:
+            try:
+                chunk = self.sock.recv(count - len(data))
+            except socket.timeout:
+                break
+            if not chunk:
+                break
+            data.extend(chunk)
+        return data
+
+    def close(self):
+        self.sock.close()
+
+
+class RtuOverTcpTransport(_SocketMixin, RtuTransport):
+    def __init__(self, host, port, timeout=1):
+        """
+        RTU frames passed through a TCP connection, which is what most serial
+        to Ethernet converters do in their "transparent" mode.
+        """
+        self._connect(host, port, timeout)
+
+
+class ModbusTcpTransport(_SocketMixin, Transport):
+    def __init__(self, host, port=MODBUS_TCP_PORT, timeout=1):
+        """
+        Modbus TCP with the MBAP header.  The device id is sent as the unit id.
+        """
+        self._connect(host, port, timeout)
+        self.__transactionId = 0
+
+    def _transact(self, deviceId, function, payload, debug):
+        self.__transactionId = (self.__transactionId + 1) & 0xFFFF
+        pdu = bytearray([function])
+        pdu.extend(payload)
+        frame = bytearray(struct.pack(">HHHB",
+                                      self.__transactionId,
+                                      0,
+                                      len(pdu) + 1,
+                                      deviceId))
+        frame.extend(pdu)
+
+        if debug:
+            print "\tSending:", " ".join(hex(m) for m in frame)
+
+        # No _discard() here, it could take half of a late frame and leave
+        # the other half to be read as a header.  Whole late frames are
+        # recognised by their transaction id instead.
+        self.lastRequest = frame
+        self.sent = clock.monotonic()
+        self._write(frame)
+
+        while True:
+            head = self.lastReply = self._readExactly(7)
+            tid, protocol, length, unit = struct.unpack(">HHHB", bytes(head))
+            if length < 2:
+                raise FrameError("Reply too short")
+            body = self._readExactly(length - 1)
+            head.extend(body)
+            # Skip late replies to earlier requests that timed out
+            if tid == self.__transactionId or \
+                    (self.__transactionId - tid) & 0xFFFF > 0x8000:
+                break
+            if debug:
+                print "\tSkipped:", " ".join('0x%01x' % m for m in head)
+        self.received = clock.monotonic()
+
+        if debug:
+            print "\tReceive:", " ".join('0x%01x' % m for m in head)
+
+        if tid != self.__transactionId or protocol != 0 or unit != deviceId:
+            raise MismatchError("Reply does not match request")
+        if (body[0] & 0x7F) != function:
+            raise MismatchError("Reply does not match request")
+        if body[0] & 0x80:
+            if len(body) < 2:
+                raise FrameError("Exception reply without a code")
+            raise ModbusError(function, body[1])
+        checkReply(function, payload, body[1:])
+        return body[1:]
+
+
+def wrap(ser):
+    """
+    Return ser unchanged if it is already a Transport, otherwise treat it as a
+    serial port and wrap it in a SerialTransport.
+    """
+    if isinstance(ser, Transport):
+        return ser
+    return SerialTransport(ser)